@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import sys
+import os
+import time
+import traceback
+import json
+
+
+def m3FilesIn(path, recurse=True, extension=".m3"):
+    """ Returns the path itself if it's a file and otherwise the paths of the files in the directory
+    which end with the extension, sorted and including the subdirectories if recurse is True """
+    if os.path.isfile(path):
+        return [path]
+    filePaths = []
+    for directory, dirs, files in os.walk(path):
+        dirs.sort()
+        for fileName in sorted(files):
+            if fileName.endswith(extension):
+                filePaths.append(os.path.join(directory, fileName))
+        if not recurse:
+            break
+    return filePaths
+
+def convertFileTask(convertFunction, inputFilePath, outputFilePath, extraArguments):
+    """ Gets executed by the worker processes of runFileConversions """
+    result = {"input": inputFilePath, "output": outputFilePath, "success": True}
+    startTime = time.perf_counter()
+    try:
+        details = convertFunction(inputFilePath, outputFilePath, *extraArguments)
+        if details is not None:
+            result.update(details)
+    except Exception as e:
+        result["success"] = False
+        result["error"] = str(e)
+        result["traceback"] = traceback.format_exc()
+    result["seconds"] = time.perf_counter() - startTime
+    return result
+
+def runFileConversions(convertFunction, filePathPairs, jobs=1, continueAtErrors=False, extraArguments=(), progressFile=None):
+    """ Calls convertFunction(inputFilePath, outputFilePath, *extraArguments) for each pair of file paths,
+    with jobs > 1 in a pool of processes. convertFunction must be a module level function so that it can be pickled
+    and may return a dictionary with details which get added to the result of the file.
+    Returns a result dictionary per file in the order of filePathPairs. Stops at the first failure unless continueAtErrors is True.
+    The progress gets written to progressFile, which defaults to stdout."""
+    if progressFile is None:
+        progressFile = sys.stdout
+    results = []
+    futures = []
+    executor = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        futures = [executor.submit(convertFileTask, convertFunction, inputFilePath, outputFilePath, extraArguments) for inputFilePath, outputFilePath in filePathPairs]
+        taskResults = (future.result() for future in futures)
+    else:
+        taskResults = (convertFileTask(convertFunction, inputFilePath, outputFilePath, extraArguments) for inputFilePath, outputFilePath in filePathPairs)
+    try:
+        for result in taskResults:
+            results.append(result)
+            progressFile.write("%s -> %s (%.2f s)\n" % (result["input"], result["output"], result["seconds"]))
+            if not result["success"]:
+                sys.stderr.write("\nError: %s\n" % result["error"])
+                sys.stderr.write("\nFile: %s\n" % result["input"])
+                sys.stderr.write("Trace: %s\n" % result["traceback"])
+                if not continueAtErrors:
+                    break
+    finally:
+        if executor is not None:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+    return results
+
+def writeConversionSummary(results, summaryFilePath, seconds):
+    """ Writes the results of runFileConversions as JSON file; "-" writes it to stdout """
+    summary = {
+        "total": len(results),
+        "succeeded": sum(1 for result in results if result["success"]),
+        "failed": sum(1 for result in results if not result["success"]),
+        "seconds": seconds,
+        "files": results
+    }
+    if summaryFilePath == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(summaryFilePath, "w") as summaryFile:
+            json.dump(summary, summaryFile, indent=2)
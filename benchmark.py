@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import sys
+import m3
+import m3ToXml
+import xmlToM3
+import generateModel
+import argparse
+import os
+import json
+import time
+import platform
+import tracemalloc
+import tempfile
+import shutil
+import multiprocessing
+
+benchmarkCases = {
+    "small": {"vertexCount": 2000, "boneCount": 20, "sequenceCount": 5, "keysPerSecond": 30, "particleSystemCount": 2},
+    "medium": {"vertexCount": 20000, "boneCount": 60, "sequenceCount": 20, "keysPerSecond": 50, "particleSystemCount": 8},
+    "large": {"vertexCount": 200000, "boneCount": 150, "sequenceCount": 40, "keysPerSecond": 100, "particleSystemCount": 20}
+}
+""" Parameters of generateModel.ModelGenerator for each model size """
+benchmarkNames = ["loadSections", "loadModel", "saveAndInvalidateModel", "printModel", "convertXmlFile"]
+
+
+def countRecords(filePath):
+    """ Counts the structures in the file, but not the elements of primitive lists like vertex bytes or strings """
+    records = 0
+    for section in m3.scanIndex(filePath)["sections"]:
+        structureHistory = m3.structures.get(section["tag"])
+        if structureHistory is None or not structureHistory.isPrimitive:
+            records += section["repetitions"]
+    return records
+
+def runBenchmark(benchmarkName, modelFilePath, workDirectory, repetitions):
+    """ Gets executed in a fresh process, so that earlier benchmarks don't affect it.
+    Returns the fastest of the repetitions in seconds and the peak of the memory in bytes which the benchmarked
+    call allocated, without the setup like loading the model to save. An additional first run does not count,
+    since it includes compiling the codecs of the structures. The memory gets traced in an additional last run,
+    since tracing slows down the call """
+    xmlFilePath = os.path.join(workDirectory, os.path.basename(modelFilePath) + ".xml")
+    outputFilePath = os.path.join(workDirectory, "output.m3")
+    if benchmarkName == "convertXmlFile" and not os.path.exists(xmlFilePath):
+        m3ToXml.printModel(m3.loadModel(modelFilePath), xmlFilePath)
+    times = []
+    peakMemoryBytes = None
+    for repetition in range(repetitions + 2):
+        if benchmarkName in ("saveAndInvalidateModel", "printModel"):
+            model = m3.loadModel(modelFilePath)
+        traceMemory = repetition == repetitions + 1
+        if traceMemory:
+            tracemalloc.start()
+        startTime = time.perf_counter()
+        if benchmarkName == "loadSections":
+            m3.loadSections(modelFilePath)
+        elif benchmarkName == "loadModel":
+            m3.loadModel(modelFilePath)
+        elif benchmarkName == "saveAndInvalidateModel":
+            m3.saveAndInvalidateModel(model, outputFilePath)
+        elif benchmarkName == "printModel":
+            m3ToXml.printModel(model, xmlFilePath)
+        elif benchmarkName == "convertXmlFile":
+            xmlToM3.convertXmlFile(xmlFilePath, outputFilePath)
+        else:
+            raise Exception("Unknown benchmark %s" % benchmarkName)
+        if traceMemory:
+            peakMemoryBytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            times.append(time.perf_counter() - startTime)
+        model = None
+    if os.path.exists(outputFilePath):
+        os.remove(outputFilePath)
+    return min(times[1:]), peakMemoryBytes
+
+def runBenchmarks(caseNames, benchmarkNamesToRun, modelDirectory, repetitions):
+    """ Returns a list with a result dictionary per case and benchmark. The throughput in bytes and records
+    per second relates to the size and number of records of the m3 file for all benchmarks """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for caseName in caseNames:
+        modelFilePath = os.path.join(modelDirectory, "benchmark-%s.m3" % caseName)
+        if not os.path.exists(modelFilePath):
+            m3.saveAndInvalidateModel(generateModel.generateModel(**benchmarkCases[caseName]), modelFilePath)
+        fileBytes = os.path.getsize(modelFilePath)
+        records = countRecords(modelFilePath)
+        for benchmarkName in benchmarkNamesToRun:
+            with context.Pool(1) as pool:
+                seconds, peakMemoryBytes = pool.apply(runBenchmark, (benchmarkName, modelFilePath, modelDirectory, repetitions))
+            result = {"case": caseName, "benchmark": benchmarkName, "seconds": seconds, "fileBytes": fileBytes, "records": records,
+                "megabytesPerSecond": fileBytes / seconds / 1e6, "recordsPerSecond": records / seconds, "peakMemoryBytes": peakMemoryBytes}
+            print("%-7s %-23s %9.4f s %9.2f MB/s %12.0f records/s %8.1f MB peak" % (caseName, benchmarkName, seconds, result["megabytesPerSecond"], result["recordsPerSecond"], peakMemoryBytes / 1e6))
+            results.append(result)
+    return results
+
+def compareWithBaseline(results, baselineResults, tolerance):
+    """ Returns a list of messages for the results which are slower or need more memory than the baseline allows """
+    baselineMap = {(result["case"], result["benchmark"]): result for result in baselineResults}
+    regressions = []
+    for result in results:
+        baselineResult = baselineMap.get((result["case"], result["benchmark"]))
+        if baselineResult is None:
+            continue
+        for key, unit in (("seconds", "s"), ("peakMemoryBytes", "bytes")):
+            ratio = result[key] / baselineResult[key]
+            if ratio > 1.0 + tolerance:
+                regressions.append("%s %s: %s %.4g %s is %.0f%% above the baseline %.4g %s" % (result["case"], result["benchmark"], key, result[key], unit, (ratio - 1.0) * 100, baselineResult[key], unit))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the speed and peak memory of reading and writing generated m3 models.')
+    parser.add_argument('--cases', default="small,medium", help='Comma separated model sizes out of %s' % ", ".join(benchmarkCases))
+    parser.add_argument('--benchmarks', default=",".join(benchmarkNames), help='Comma separated benchmarks out of %s' % ", ".join(benchmarkNames))
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of which the fastest one counts')
+    parser.add_argument('--model-directory', help='Directory for the generated models which get reused by later runs; by default a temporary directory')
+    parser.add_argument('--output', '-o', help='Write the results as JSON to this file, which can serve as baseline of later runs')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative increase of time or memory compared to the baseline which counts as regression')
+    args = parser.parse_args()
+
+    caseNames = args.cases.split(",")
+    benchmarkNamesToRun = args.benchmarks.split(",")
+    for caseName in caseNames:
+        if caseName not in benchmarkCases:
+            sys.stderr.write("Unknown case %s\n" % caseName)
+            sys.exit(2)
+    for benchmarkName in benchmarkNamesToRun:
+        if benchmarkName not in benchmarkNames:
+            sys.stderr.write("Unknown benchmark %s\n" % benchmarkName)
+            sys.exit(2)
+
+    if args.model_directory is not None:
+        os.makedirs(args.model_directory, exist_ok=True)
+        modelDirectory = args.model_directory
+    else:
+        modelDirectory = tempfile.mkdtemp(prefix="m3benchmark")
+    try:
+        results = runBenchmarks(caseNames, benchmarkNamesToRun, modelDirectory, args.repeat)
+    finally:
+        if args.model_directory is None:
+            shutil.rmtree(modelDirectory)
+
+    if args.output is not None:
+        with open(args.output, "w") as outputFile:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, outputFile, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as baselineFile:
+            baselineResults = json.load(baselineFile)["results"]
+        regressions = compareWithBaseline(results, baselineResults, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions compared to %s" % args.baseline)
@@ -21,81 +21,242 @@
 
 import m3
 import sys
+import os
 import os.path
 import argparse
 import time
+import re
+import struct
+import ctypes
+import ctypes.util
+
+class InotifyFileWatcher:
+    """ Waits for changes of a file with the inotify API of Linux. The directory gets watched,
+    since editors often replace files instead of writing into them """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    eventHeader = struct.Struct("iIII")
+
+    def __init__(self, fileName):
+        libcName = ctypes.util.find_library("c")
+        if libcName is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libcName, use_errno=True)
+        self.fileName = os.path.basename(fileName).encode()
+        self.fileDescriptor = libc.inotify_init()
+        if self.fileDescriptor < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        directory = os.path.dirname(os.path.abspath(fileName)).encode()
+        # A created file is still being written, it gets reported with IN_CLOSE_WRITE once it is complete:
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if libc.inotify_add_watch(self.fileDescriptor, directory, mask) < 0:
+            os.close(self.fileDescriptor)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def waitForChange(self):
+        while True:
+            data = os.read(self.fileDescriptor, 4096)
+            offset = 0
+            while offset < len(data):
+                watchDescriptor, mask, cookie, nameLength = self.eventHeader.unpack_from(data, offset)
+                offset += self.eventHeader.size
+                name = data[offset:offset + nameLength].rstrip(b"\0")
+                offset += nameLength
+                if name == self.fileName:
+                    return
+
+    def close(self):
+        os.close(self.fileDescriptor)
+
+
+class PollingFileWatcher:
+    """ Waits for changes of a file by checking its modification time periodically """
+
+    def __init__(self, fileName, interval=0.1):
+        self.fileName = fileName
+        self.interval = interval
+        self.modificationTime = os.path.getmtime(fileName)
+
+    def waitForChange(self):
+        while True:
+            time.sleep(self.interval)
+            modificationTime = os.path.getmtime(self.fileName)
+            if modificationTime != self.modificationTime:
+                self.modificationTime = modificationTime
+                return
+
+    def close(self):
+        pass
+
+
+def createFileWatcher(fileName, polling=False):
+    if not polling:
+        try:
+            return InotifyFileWatcher(fileName)
+        except (OSError, AttributeError):
+            pass
+    return PollingFileWatcher(fileName)
+
+
+# The two most significant bytes of a little endian float with all exponent bits set, like every NaN has:
+possibleNaNPattern = re.compile(b"[\x80-\xff][\x7f\xff]")
+
+class ChangeLogDiffer(m3.ModelDiffer):
+    """ Compares two snapshots like a walk over the fully loaded models: Arrays and lists of primitive values get compared
+    as a whole, the elements of structure lists with a different length don't get compared and since NaN values differ
+    from each other, sections with NaN values never count as unchanged.
+
+    nanCache maps section hashes to whether the sections contain NaN values. It gets reused between snapshots """
+
+    def __init__(self, previous, current, nanCache):
+        m3.ModelDiffer.__init__(self, previous, current)
+        self.nanCache = nanCache
+        self.subtreeNaNMaps = {id(previous): {}, id(current): {}}
+
+    def diffStructures(self, previous, current, path, recordBytesEqual=False):
+        previousType = previous.structureDescription
+        currentType = current.structureDescription
+        if currentType.structureName != previousType.structureName:
+            self.addDifference(path, "structure type", previousType.structureName, currentType.structureName)
+        elif currentType.structureVersion != previousType.structureVersion:
+            self.addDifference(path, "structure version", previousType.structureVersion, currentType.structureVersion)
+        else:
+            m3.ModelDiffer.diffStructures(self, previous, current, path, recordBytesEqual)
+
+    def diffValues(self, old, new, path):
+        if old != new:
+            self.addDifference(path, "value", old, new)
+
+    def diffReferences(self, previous, current, field, path):
+        previousIndex = self.previous.referencedSectionIndex(previous, field)
+        currentIndex = self.current.referencedSectionIndex(current, field)
+        if self.subtreesEqual(previousIndex, currentIndex):
+            return
+        old = getattr(previous, field.name)
+        new = getattr(current, field.name)
+        if not isinstance(field, m3.StructureReferenceField):
+            self.diffValues(old, new, path)
+        elif len(old) != len(new):
+            self.addDifference(path, "length", len(old), len(new))
+        else:
+            for index, (oldElement, newElement) in enumerate(zip(old, new)):
+                self.diffStructures(oldElement, newElement, "%s[%d]" % (path, index), self.recordsEqual(previousIndex, currentIndex, index))
+
+    def subtreesEqual(self, previousIndex, currentIndex):
+        return m3.ModelDiffer.subtreesEqual(self, previousIndex, currentIndex) and not self.subtreeContainsNaN(self.previous, previousIndex)
+
+    def recordsEqual(self, previousIndex, currentIndex, recordIndex):
+        return m3.ModelDiffer.recordsEqual(self, previousIndex, currentIndex, recordIndex) and not self.sectionContainsNaN(self.previous, previousIndex)
+
+    def subtreeContainsNaN(self, hashedModel, sectionIndex):
+        subtreeNaNMap = self.subtreeNaNMaps[id(hashedModel)]
+        containsNaN = subtreeNaNMap.get(sectionIndex)
+        if containsNaN is None:
+            containsNaN = self.sectionContainsNaN(hashedModel, sectionIndex)
+            for childIndex in hashedModel.childrenOfSection(sectionIndex):
+                if containsNaN:
+                    break
+                containsNaN = self.subtreeContainsNaN(hashedModel, childIndex)
+            subtreeNaNMap[sectionIndex] = containsNaN
+        return containsNaN
+
+    def sectionContainsNaN(self, hashedModel, sectionIndex):
+        sectionHash = hashedModel.sectionHashes[sectionIndex]
+        containsNaN = self.nanCache.get(sectionHash)
+        if containsNaN is None:
+            section = hashedModel.sections[sectionIndex]
+            containsNaN = False
+            if containsFloats(section.structureDescription) and possibleNaNPattern.search(section.rawBytes) is not None:
+                hashedModel.sectionLoader.determineContentOfSection(sectionIndex)
+                if section.structureDescription.isPrimitive:
+                    containsNaN = any(value != value for value in section.content)
+                else:
+                    containsNaN = any(structureContainsNaN(instance) for instance in section.content)
+            self.nanCache[sectionHash] = containsNaN
+        return containsNaN
+
+
+def containsFloats(structureDescription):
+    if structureDescription.structureName == "REAL":
+        return True
+    for field in structureDescription.fields:
+        if isinstance(field, m3.FloatField):
+            return True
+        if isinstance(field, m3.EmbeddedStructureField) and containsFloats(field.structureDescription):
+            return True
+    return False
+
+def structureContainsNaN(instance):
+    for field in instance.structureDescription.fields:
+        if isinstance(field, m3.FloatField):
+            value = getattr(instance, field.name)
+            if value != value:
+                return True
+        elif isinstance(field, m3.EmbeddedStructureField) and structureContainsNaN(getattr(instance, field.name)):
+            return True
+    return False
 
-modelFileName = sys.argv[1]
 
 class ChangeLogCreator:
 
-    def __init__(self, modelFileName, logFileName):
+    def __init__(self, modelFileName, logFileName, polling=False):
         self.modelFileName = modelFileName
         self.logFileName = logFileName
+        self.polling = polling
+        self.nanCache = {}
 
     def createChangeLog(self):
         self.logFile = open(self.logFileName, "w")
+        watcher = createFileWatcher(self.modelFileName, self.polling)
         try:
             previousModelModiticationTime = os.path.getmtime(self.modelFileName)
             self.log("Log file started at %s" % time.ctime(previousModelModiticationTime))
-            previousModel = m3.loadModel(self.modelFileName, checkExpectedValue=False)
+            self.previousSnapshot = m3.HashedModel(self.modelFileName)
             while True:
+                watcher.waitForChange()
                 currentModelModificationTime = os.path.getmtime(self.modelFileName)
                 if currentModelModificationTime > previousModelModiticationTime:
                     self.log("")
                     self.log("File modified at %s" % time.ctime(currentModelModificationTime))
-                    currentModel = m3.loadModel(self.modelFileName)
-                    self.changedAnimationIds = 0
-                    self.compareM3Structures(previousModel, currentModel, "model")
-                    if self.changedAnimationIds > 0:
-                        self.log("%d animation ids have changed!" % self.changedAnimationIds)
+                    try:
+                        self.logChangesSincePreviousSnapshot()
+                    except Exception as e:
+                        # The previous snapshot stays, so that the next change gets compared with it again:
+                        sys.stderr.write("Failed to load %s: %s\n" % (self.modelFileName, e))
+                        continue
                     previousModelModiticationTime = currentModelModificationTime
-                    previousModel = currentModel
-                time.sleep(0.1)
         finally:
+            watcher.close()
             self.logFile.close()
 
-    def compareM3Structures(self, previous, current, structurePath):
-        previousType = previous.structureDescription
-        currentType = current.structureDescription
-        if currentType.structureName != previousType.structureName:
-            self.log("%s changed its structure type from %s to %s" % (structurePath, previousType.structureName, currentType.structureName))
-            return
-
-        if currentType.structureVersion != previousType.structureVersion:
-            self.log("%s changed its structure version from %s to %s" % (structurePath, previousType.structureVersion, currentType.structureVersion))
-            return
-
-        for field in previousType.fields:
-            fieldPath = structurePath + "." + field.name
-            previousFieldContent = getattr(previous, field.name)
-            currentFieldContent = getattr(current, field.name)
-            if isinstance(field, m3.EmbeddedStructureField):
-                self.compareM3Structures(previousFieldContent, currentFieldContent, fieldPath)
-            elif isinstance(field, m3.StructureReferenceField):
-                currentLength = len(currentFieldContent)
-                previousLength = len(previousFieldContent)
-                if len(currentFieldContent) != previousLength:
-                    self.log("The length of %s changed from %d to %d" % (fieldPath, previousLength, currentLength))
-                else:
-                    elementIndex = 0
-                    for previousElement, currentElement in zip(previousFieldContent, currentFieldContent):
-                        elementPath = "%s[%d]" % (fieldPath, elementIndex)
-                        self.compareM3Structures(previousElement, currentElement, elementPath)
-                        elementIndex += 1
+    def logChangesSincePreviousSnapshot(self):
+        self.currentSnapshot = m3.HashedModel(self.modelFileName, self.previousSnapshot.childrenCache)
+        changedAnimationIds = 0
+        differences = ChangeLogDiffer(self.previousSnapshot, self.currentSnapshot, self.nanCache).diff()
+        # Keep only the entries of the sections that the next comparison can encounter:
+        currentSectionHashes = set(self.currentSnapshot.sectionHashes)
+        self.nanCache = {sectionHash: containsNaN for sectionHash, containsNaN in self.nanCache.items() if sectionHash in currentSectionHashes}
+        for difference in differences:
+            if difference["kind"] == "value" and difference["path"].endswith((".animId", ".uniqueUnknownNumber")):
+                changedAnimationIds += 1
             else:
+                self.log(self.describeDifference(difference))
+        if changedAnimationIds > 0:
+            self.log("%d animation ids have changed!" % changedAnimationIds)
+        self.previousSnapshot = self.currentSnapshot
 
-                if currentFieldContent != previousFieldContent:
-                    if field.name != "animId" and field.name != "uniqueUnknownNumber":
-                        if isinstance(field, m3.IntField):
-                            previousFieldContentStr = hex(previousFieldContent)
-                            currentFieldContentStr = hex(currentFieldContent)
-                        else:
-                            previousFieldContentStr = str(previousFieldContent)
-                            currentFieldContentStr = str(currentFieldContent)
-                        self.log("%s changed from %s to %s" % (fieldPath, previousFieldContentStr, currentFieldContentStr))
-                    else:
-                        self.changedAnimationIds += 1
+    def describeDifference(self, difference):
+        path = difference["path"]
+        kind = difference["kind"]
+        old = difference["old"]
+        new = difference["new"]
+        if kind in ("structure type", "structure version"):
+            return "%s changed its %s from %s to %s" % (path, kind, old, new)
+        elif kind == "length":
+            return "The length of %s changed from %d to %d" % (path, old, new)
+        if isinstance(old, int) and isinstance(new, int):
+            return "%s changed from %s to %s" % (path, hex(old), hex(new))
+        return "%s changed from %s to %s" % (path, old, new)
 
     def log(self, message):
         self.logFile.write(str(message) + "\n")
@@ -106,10 +267,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('m3File', help="The m3 file for which a change log should be created")
     parser.add_argument('--log-file', '-l', help='Directory in which m3 files will be placed')
+    parser.add_argument('--poll', action='store_true', default=False, help='Check the modification time periodically instead of using inotify')
     args = parser.parse_args()
     modelFileName = args.m3File
     logFileName = args.log_file
     if logFileName is None:
         logFileName = modelFileName[:-3] + "-changelog.txt"
-    changeLogCreator = ChangeLogCreator(modelFileName, logFileName)
+    changeLogCreator = ChangeLogCreator(modelFileName, logFileName, args.poll)
     changeLogCreator.createChangeLog()
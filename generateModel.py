@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import m3
+import argparse
+import random
+import time
+import math
+import struct
+
+maximumVerticesPerRegion = 0xffff
+""" Face vertex indices are 16 bit values relative to the first vertex of the region """
+vertexPatternSize = 4096
+""" Number of random vertices which get repeated to fill the vertex buffer """
+
+
+class ModelGenerator:
+    """ Builds a valid model of arbitrary size for scale tests. The same parameters and seed result in the same file """
+
+    def __init__(self, vertexCount=1000, vertexFlags=0x182007d, boneCount=10, hierarchyDepth=4, sequenceCount=2,
+            sequenceLengthInMS=2000, keysPerSecond=30, materialCount=1, particleSystemCount=0, seed=0):
+        self.vertexCount = vertexCount
+        self.vertexFlags = vertexFlags
+        self.boneCount = boneCount
+        self.hierarchyDepth = hierarchyDepth
+        self.sequenceCount = sequenceCount
+        self.sequenceLengthInMS = sequenceLengthInMS
+        self.keysPerSecond = keysPerSecond
+        self.materialCount = materialCount
+        self.particleSystemCount = particleSystemCount
+        self.random = random.Random(seed)
+        self.structureVersionMap = {"MODL": 23, "SEQS": 1, "LAYR": 22, "MAT_": 15, "PAR_": 12, "BONE": 1, "SD3V": 0, "SD4Q": 0,
+            "VEC3": 0, "QUAT": 0, "DIV_": 2, "REGN": 3, "BAT_": 1, "MSEC": 1, "STG_": 0, "STC_": 4, "STS_": 0, "IREF": 0, "MATM": 0}
+        if hierarchyDepth < 1:
+            raise Exception("The hierarchy depth must be at least 1")
+        if materialCount < 1 and vertexCount > 0:
+            raise Exception("A model with vertices needs at least one material")
+        if "VertexFormat" + hex(vertexFlags) not in m3.structures:
+            raise Exception("There is no vertex format for the flags %s" % hex(vertexFlags))
+
+    def createInstanceOf(self, structureName):
+        version = self.structureVersionMap[structureName]
+        structureDescription = m3.structures[structureName].getVersion(version)
+        return structureDescription.createInstance()
+
+    def generateModel(self):
+        model = self.createInstanceOf("MODL")
+        model.modelName = "Generated"
+        model.vFlags = self.vertexFlags
+        self.addBones(model)
+        self.addMaterials(model)
+        self.addMesh(model)
+        self.addSequences(model)
+        self.addParticleSystems(model)
+        return model
+
+    def addBones(self, model):
+        """ Bone 0 is the root; the other bones form chains below it, so that no bone is deeper than hierarchyDepth """
+        for boneIndex in range(self.boneCount):
+            bone = self.createInstanceOf("BONE")
+            bone.name = "Bone%d" % boneIndex
+            if boneIndex == 0 or self.hierarchyDepth == 1:
+                bone.parent = -1
+            elif (boneIndex - 1) % (self.hierarchyDepth - 1) == 0:
+                bone.parent = 0
+            else:
+                bone.parent = boneIndex - 1
+            bone.location.header.animId = self.random.getrandbits(32)
+            bone.rotation.header.animId = self.random.getrandbits(32)
+            bone.scale.header.animId = self.random.getrandbits(32)
+            bone.location.initValue.x = self.random.uniform(-1.0, 1.0)
+            bone.location.initValue.y = self.random.uniform(-1.0, 1.0)
+            bone.location.initValue.z = self.random.uniform(-1.0, 1.0)
+            model.bones.append(bone)
+            model.absoluteInverseBoneRestPositions.append(self.createInstanceOf("IREF"))
+
+    def addMaterials(self, model):
+        for materialIndex in range(self.materialCount):
+            material = self.createInstanceOf("MAT_")
+            material.name = "Material%d" % materialIndex
+            for field in material.structureDescription.fields:
+                if isinstance(field, m3.StructureReferenceField) and field.historyOfReferencedStructures.name == "LAYR":
+                    layer = self.createInstanceOf("LAYR")
+                    layer.imagePath = "Assets/Textures/Generated%d_%s.dds" % (materialIndex, field.name)
+                    setattr(material, field.name, [layer])
+            model.standardMaterials.append(material)
+            materialReference = self.createInstanceOf("MATM")
+            materialReference.materialType = 1 # standard material
+            materialReference.materialIndex = materialIndex
+            model.materialReferences.append(materialReference)
+
+    def vertexColumnValues(self, columnName, formatChar, count, boneLookupCount):
+        randomGenerator = self.random
+        if columnName == "boneWeight0":
+            return [255 if boneLookupCount > 0 else 0] * count
+        if columnName == "boneLookupIndex0" and boneLookupCount > 0:
+            return [randomGenerator.randrange(boneLookupCount) for i in range(count)]
+        if columnName.startswith("boneWeight") or columnName.startswith("boneLookupIndex"):
+            return [0] * count
+        if formatChar == "f":
+            return [randomGenerator.uniform(-1.0, 1.0) for i in range(count)]
+        if columnName.startswith("uv"):
+            # UV coordinates get stored as multiples of 1/2048:
+            return [randomGenerator.randrange(2048) for i in range(count)]
+        valueBits = 8 * struct.calcsize("<" + formatChar)
+        if formatChar.islower():
+            valueBits -= 1
+        return [randomGenerator.getrandbits(valueBits) for i in range(count)]
+
+    def generateVertexBytes(self, boneLookupCount):
+        """ Generates vertexPatternSize random vertices and repeats them, since generating every vertex would take too long for huge models """
+        vertexDescription = m3.structures["VertexFormat" + hex(self.vertexFlags)].getVersion(0)
+        patternCount = min(self.vertexCount, vertexPatternSize)
+        columns = [self.vertexColumnValues(columnName, formatChar, patternCount, boneLookupCount) for columnName, formatChar in vertexDescription.rawColumnFormats()]
+        pattern = vertexDescription.rawColumnsToBytes(columns)
+        if patternCount == 0:
+            return pattern
+        repetitions = -(-self.vertexCount // patternCount)
+        vertices = pattern * repetitions
+        del vertices[self.vertexCount * vertexDescription.size:]
+        return vertices
+
+    def addMesh(self, model):
+        boneLookupCount = min(self.boneCount, 256)
+        model.boneLookup = list(range(boneLookupCount))
+        model.vertices = self.generateVertexBytes(boneLookupCount)
+        division = self.createInstanceOf("DIV_")
+        regionFacesMap = {}
+        firstVertexIndex = 0
+        while firstVertexIndex < self.vertexCount:
+            regionIndex = len(division.regions)
+            regionVertexCount = min(self.vertexCount - firstVertexIndex, maximumVerticesPerRegion)
+            # One triangle per vertex, connecting it with its two successors:
+            regionFaces = regionFacesMap.get(regionVertexCount)
+            if regionFaces is None:
+                regionFaces = [(vertexIndex + corner) % regionVertexCount for vertexIndex in range(regionVertexCount) for corner in range(3)]
+                regionFacesMap[regionVertexCount] = regionFaces
+            region = self.createInstanceOf("REGN")
+            region.firstVertexIndex = firstVertexIndex
+            region.numberOfVertices = regionVertexCount
+            region.firstFaceVertexIndexIndex = len(division.faces)
+            region.numberOfFaceVertexIndices = len(regionFaces)
+            region.numberOfBones = boneLookupCount
+            region.firstBoneLookupIndex = 0
+            region.numberOfBoneLookupIndices = boneLookupCount
+            region.numberOfBoneWeightPairsPerVertex = 1 if boneLookupCount > 0 else 0
+            division.faces.extend(regionFaces)
+            division.regions.append(region)
+            batch = self.createInstanceOf("BAT_")
+            batch.regionIndex = regionIndex
+            batch.materialReferenceIndex = regionIndex % self.materialCount
+            division.objects.append(batch)
+            firstVertexIndex += regionVertexCount
+        division.msec = [self.createInstanceOf("MSEC")]
+        model.divisions = [division]
+
+    def keyFrames(self):
+        keyCount = max(2, self.sequenceLengthInMS * self.keysPerSecond // 1000 + 1)
+        return [round(keyIndex * self.sequenceLengthInMS / (keyCount - 1)) for keyIndex in range(keyCount)]
+
+    def addSequences(self, model):
+        """ Each sequence animates the location and rotation of all bones """
+        frames = self.keyFrames()
+        randomGenerator = self.random
+        for sequenceIndex in range(self.sequenceCount):
+            sequence = self.createInstanceOf("SEQS")
+            sequence.name = "Sequence%d" % sequenceIndex
+            sequence.animEndInMS = self.sequenceLengthInMS
+            model.sequences.append(sequence)
+            stc = self.createInstanceOf("STC_")
+            stc.name = "Sequence%d_full" % sequenceIndex
+            stc.stsIndex = sequenceIndex
+            stc.stsIndexCopy = sequenceIndex
+            for bone in model.bones:
+                locations = self.createInstanceOf("SD3V")
+                locations.frames = list(frames)
+                locations.fend = self.sequenceLengthInMS
+                for frame in frames:
+                    key = self.createInstanceOf("VEC3")
+                    key.x = randomGenerator.uniform(-1.0, 1.0)
+                    key.y = randomGenerator.uniform(-1.0, 1.0)
+                    key.z = randomGenerator.uniform(-1.0, 1.0)
+                    locations.keys.append(key)
+                stc.animIds.append(bone.location.header.animId)
+                stc.animRefs.append(0x20000 + len(stc.sd3v))
+                stc.sd3v.append(locations)
+
+                rotations = self.createInstanceOf("SD4Q")
+                rotations.frames = list(frames)
+                rotations.fend = self.sequenceLengthInMS
+                for frame in frames:
+                    key = self.createInstanceOf("QUAT")
+                    angle = randomGenerator.uniform(-3.14159, 3.14159)
+                    key.z = math.sin(angle / 2)
+                    key.w = math.cos(angle / 2)
+                    rotations.keys.append(key)
+                stc.animIds.append(bone.rotation.header.animId)
+                stc.animRefs.append(0x30000 + len(stc.sd4q))
+                stc.sd4q.append(rotations)
+            model.sequenceTransformationCollections.append(stc)
+            stg = self.createInstanceOf("STG_")
+            # A separate string object, since the same object would get saved only once and then differ from an XML round trip:
+            stg.name = "Sequence%d" % sequenceIndex
+            stg.stcIndices = [sequenceIndex]
+            model.sequenceTransformationGroups.append(stg)
+            sts = self.createInstanceOf("STS_")
+            sts.animIds = list(stc.animIds)
+            model.sts.append(sts)
+
+    def addParticleSystems(self, model):
+        for particleSystemIndex in range(self.particleSystemCount):
+            particleSystem = self.createInstanceOf("PAR_")
+            particleSystem.boneIndex = particleSystemIndex % self.boneCount if self.boneCount > 0 else 0
+            particleSystem.materialReferenceIndex = particleSystemIndex % self.materialCount if self.materialCount > 0 else 0
+            particleSystem.emissionSpeed1.initValue = self.random.uniform(0.0, 5.0)
+            particleSystem.lifespan1.initValue = self.random.uniform(0.5, 3.0)
+            model.particles.append(particleSystem)
+
+
+def generateModel(**parameters):
+    """ Returns a new model, see ModelGenerator for the parameters """
+    return ModelGenerator(**parameters).generateModel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a valid m3 file of arbitrary size for scale tests. The same arguments always produce the same file.')
+    parser.add_argument('outputFile', help="The m3 file to create")
+    parser.add_argument('--vertices', type=int, default=1000, help='Number of vertices')
+    parser.add_argument('--vertex-flags', default="0x182007d", help='Vertex format flags, for which a VertexFormat structure must exist')
+    parser.add_argument('--bones', type=int, default=10, help='Number of bones')
+    parser.add_argument('--hierarchy-depth', type=int, default=4, help='Maximum number of bone levels including the root bone')
+    parser.add_argument('--sequences', type=int, default=2, help='Number of animation sequences, each animating the location and rotation of all bones')
+    parser.add_argument('--sequence-length', type=int, default=2000, help='Length of each sequence in milliseconds')
+    parser.add_argument('--keys-per-second', type=int, default=30, help='Key frame density of the animations')
+    parser.add_argument('--materials', type=int, default=1, help='Number of standard materials')
+    parser.add_argument('--particle-systems', type=int, default=0, help='Number of particle systems')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random values')
+    parser.add_argument('--validation', choices=m3.validationLevels, default="full", help='How thoroughly the model gets validated before saving it')
+    args = parser.parse_args()
+
+    startTime = time.time()
+    modelGenerator = ModelGenerator(vertexCount=args.vertices, vertexFlags=int(args.vertex_flags, 0), boneCount=args.bones, hierarchyDepth=args.hierarchy_depth,
+        sequenceCount=args.sequences, sequenceLengthInMS=args.sequence_length, keysPerSecond=args.keys_per_second, materialCount=args.materials,
+        particleSystemCount=args.particle_systems, seed=args.seed)
+    model = modelGenerator.generateModel()
+    m3.saveAndInvalidateModel(model, args.outputFile, args.validation)
+    print("Generated %s in %.2f s" % (args.outputFile, time.time() - startTime))
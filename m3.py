@@ -23,7 +23,30 @@ import xml.dom.minidom
 from xml.dom.minidom import Node
 import re
 from sys import stderr
+import sys
 import struct
+import array
+import mmap
+import hashlib
+import pickle
+import os
+import copy
+
+numpyModule = None
+numpyImportAttempted = False
+
+def getNumpy():
+    """ Returns the numpy module or None if it's not installed.
+    It gets imported on first use since importing it takes longer than loading the structure definitions """
+    global numpyModule, numpyImportAttempted
+    if not numpyImportAttempted:
+        numpyImportAttempted = True
+        try:
+            import numpy
+            numpyModule = numpy
+        except ImportError:
+            pass
+    return numpyModule
 
 def increaseToValidSectionSize(size):
     blockSize = 16
@@ -39,24 +62,37 @@ class Section:
 
     def __init__(self):
         self.timesReferenced = 0
+        self.references = None
 
     def determineContentField(self, checkExpectedValue):
         indexEntry = self.indexEntry
         self.content = self.structureDescription.createInstances(buffer=self.rawBytes, count=indexEntry.repetitions, checkExpectedValue=checkExpectedValue)
 
+    def determineReferences(self):
+        """ Returns a list with a tuple (referenced section index, entries, flags, offset in section, field path)
+        for each Reference and SmallReference stored in the raw bytes of the section. The flags are None for a SmallReference """
+        if self.references is None:
+            self.references = []
+            self.structureDescription.createInstances(buffer=self.rawBytes, count=self.indexEntry.repetitions, checkExpectedValue=False, references=self.references)
+        return self.references
+
     def determineFieldRawBytes(self):
-        minRawBytes = self.determineRawBytesWithData()
-        if len(minRawBytes) != self.bytesRequiredForContent():
-            raise Exception("Section size calculation failed: Expected %s but was %s for %s; content: %s" % (self.bytesRequiredForContent(), len(minRawBytes), self.structureDescription.structureName, minRawBytes))
-        sectionSize = increaseToValidSectionSize(len(minRawBytes))
-        if len(minRawBytes) == sectionSize:
-            self.rawBytes = minRawBytes
-        else:
-            rawBytes = bytearray(sectionSize)
-            rawBytes[0:len(minRawBytes)] = minRawBytes
-            for i in range(len(minRawBytes), sectionSize):
-                rawBytes[i] = 0xaa
-            self.rawBytes = rawBytes
+        bytesRequired = self.bytesRequiredForContent()
+        rawBytes = bytearray(increaseToValidSectionSize(bytesRequired))
+        self.writeContentToBuffer(rawBytes, 0, bytesRequired)
+        self.rawBytes = rawBytes
+
+    def writeContentToBuffer(self, buffer, offset, bytesRequired=None):
+        """ Encodes the content directly into the buffer at the given offset and pads it with 0xaa to a valid section size.
+        Returns the offset after the section """
+        if bytesRequired is None:
+            bytesRequired = self.bytesRequiredForContent()
+        contentEnd = self.structureDescription.writeInstancesToBuffer(self.content, buffer, offset)
+        if contentEnd - offset != bytesRequired:
+            raise Exception("Section size calculation failed: Expected %s but was %s for %s" % (bytesRequired, contentEnd - offset, self.structureDescription.structureName))
+        sectionEnd = offset + increaseToValidSectionSize(bytesRequired)
+        buffer[contentEnd:sectionEnd] = b"\xaa" * (sectionEnd - contentEnd)
+        return sectionEnd
 
     def determineRawBytesWithData(self):
         return self.structureDescription.instancesToBytes(self.content)
@@ -69,6 +105,102 @@ class Section:
             for object in self.content:
                 object.resolveReferences(sections)
 
+    def prepareLazyReferences(self, sectionLoader):
+        if not self.structureDescription.isPrimitive:
+            for object in self.content:
+                object.prepareLazyReferences(sectionLoader)
+
+    def startChangeTracking(self, sections):
+        self.loadedSections = sections
+        self.modified = False
+        if not self.structureDescription.isPrimitive:
+            self.originalContent = list(self.content)
+            for object in self.content:
+                object.startChangeTracking(self)
+
+    def validateContent(self, validation):
+        indexEntry = self.indexEntry
+        for index, instance in enumerate(self.content):
+            instanceName = "%sV%d[%d]" % (indexEntry.tag, indexEntry.version, index)
+            if validation == "full":
+                instance.structureDescription.validateInstance(instance, instanceName)
+            elif validation == "structural":
+                instance.structureDescription.validateInstanceStructure(instance, instanceName)
+
+    def determineChangedRawBytes(self, sections, validation, referenceCounts):
+        """ Returns the raw bytes of the section for saveChangedModel: The original ones if the content did not change
+        or re-encoded ones with the original size. Returns None if the content does no longer fit into the original layout.
+        Modified structures get validated at the given validation level before they get encoded.
+        referenceCounts contains the number of references to each section and gets updated with the changed references """
+        structureDescription = self.structureDescription
+        if structureDescription.countInstances(self.content) != self.indexEntry.repetitions:
+            return None
+        if structureDescription.isPrimitive:
+            # Lists like animIds can be modified in place, so compare the encoded content:
+            contentBytes = structureDescription.instancesToBytes(self.content)
+            if self.rawBytes[:len(contentBytes)] == contentBytes:
+                return self.rawBytes
+        else:
+            if not self.modified and all(a is b for a, b in zip(self.content, self.originalContent)):
+                return self.rawBytes
+            self.validateContent(validation)
+            # The decoded original records still have the index references, which remain valid for unchanged lists:
+            originalRecords = structureDescription.createInstances(buffer=self.rawBytes, count=self.indexEntry.repetitions, checkExpectedValue=False)
+            fields = structureDescription.fields
+            for sectionIndex in self.referencedSectionIndices(originalRecords):
+                referenceCounts[sectionIndex] -= 1
+            for record, originalRecord in zip(self.content, originalRecords):
+                if record.structureDescription is not structureDescription:
+                    return None
+                for field in fields:
+                    if not field.transferToOriginalRecord(record, originalRecord, sections):
+                        return None
+            for sectionIndex in self.referencedSectionIndices(originalRecords):
+                referenceCounts[sectionIndex] += 1
+            contentBytes = structureDescription.instancesToBytes(originalRecords)
+        rawBytes = bytearray(self.rawBytes)
+        rawBytes[0:len(contentBytes)] = contentBytes
+        return rawBytes
+
+    def referencedSectionIndices(self, records):
+        """ Returns the section indices of the index references in the given records, once per reference """
+        sectionIndices = []
+        fields = self.structureDescription.fields
+        for record in records:
+            for field in fields:
+                field.addReferencedSectionIndices(record, sectionIndices)
+        return sectionIndices
+
+
+class LazySectionLoader:
+    """ Decodes the sections of a model loaded with lazy=True when they get referenced for the first time """
+
+    def __init__(self, sections, checkExpectedValue):
+        self.sections = sections
+        self.checkExpectedValue = checkExpectedValue
+
+    def determineContentOfSection(self, sectionIndex):
+        section = self.sections[sectionIndex]
+        if not hasattr(section, "content"):
+            section.determineContentField(self.checkExpectedValue)
+            section.prepareLazyReferences(self)
+
+
+class LazyReference:
+    """ Proxy for the content of a reference field of a model loaded with lazy=True:
+    The referenced section gets decoded and the reference resolved on first access """
+
+    def __init__(self, field, reference, sectionLoader):
+        self.field = field
+        self.reference = reference
+        self.sectionLoader = sectionLoader
+
+    def resolve(self, owner):
+        if self.reference.entries != 0 and self.reference.index < len(self.sectionLoader.sections):
+            self.sectionLoader.determineContentOfSection(self.reference.index)
+        setattr(owner, self.field.name, self.reference)
+        self.field.resolveIndexReferences(owner, self.sectionLoader.sections)
+
 
 primitiveFieldTypeSizes = {"uint32": 4, "int32": 4, "uint16": 2, "int16": 2, "uint8": 1, "int8": 1, "float": 4, "tag": 4, "fixed8": 1}
 primitiveFieldTypeFormats = {"uint32": "I", "int32": "i", "uint16": "H", "int16": "h", "uint8": "B", "int8": "b", "float": "f", "tag": "4s", "fixed8": "B"}
@@ -85,9 +217,8 @@ class M3StructureHistory:
         self.allFields = allFields
         self.versionToStructureDescriptionMap = {}
         self.isPrimitive = self.name in structureNamesOfPrimitiveTypes
-        # Create all to check sizes:
-        for version in versionToSizeMap:
-            self.getVersion(version)
+        # The structure descriptions get created when they get used for the first time.
+        # Use verifySchema to create and check all of them.
 
     def getVersion(self, version):
         structure = self.versionToStructureDescriptionMap.get(version)
@@ -151,31 +282,148 @@ class M3StructureDescription:
             nameToFieldMap[field.name] = field
         self.nameToFieldMap = nameToFieldMap
 
+        # Instances get created from a class with __slots__ for exactly the fields of this structure version:
+        classAttributes = {"__slots__": tuple(nameToFieldMap), "structureDescription": self}
+        self.structureClass = type("%sV%d" % (structureName, structureVersion), (M3Structure,), classAttributes)
+
+        # Created on first use, see getTrackedStructureClass:
+        self.trackedStructureClass = None
+
+        # The record codec gets compiled on first use, see compileRecordCodec:
+        self.recordStruct = None
+        self.readRecordValues = None
+        self.recordValuesOf = None
+        self.recordReferences = None
+
+    def getTrackedStructureClass(self):
+        """ Returns a subclass of structureClass which marks the loadedSection of an instance as modified when a field gets set """
+        if self.trackedStructureClass is None:
+            classAttributes = {"__slots__": (), "__setattr__": setAttributeAndMarkSectionModified}
+            self.trackedStructureClass = type(self.structureClass.__name__ + "Tracked", (self.structureClass,), classAttributes)
+        return self.trackedStructureClass
+
+    def compileRecordCodec(self):
+        """ Compiles a struct.Struct for the whole fixed size layout of the structure together with
+        two generated functions: readRecordValues(instance, values, checkExpectedValue) which fills an
+        instance with the tuple unpacked by the struct and recordValuesOf(instance) which returns the
+        tuple to pack. Embedded structures, references, tags and fixed8 values are flattened into it.
+        For structures with references a third function recordReferences(values, recordOffset, references)
+        gets generated, which adds the references of the unpacked tuple to a list, see Section.determineReferences"""
+        builder = RecordCodecBuilder()
+        self.addFieldsToCodec(builder, "instance", "instance")
+        recordStruct = struct.Struct(builder.structFormatString())
+        if recordStruct.size != self.size:
+            raise Exception("Compiled record codec of %s in version %d has size %d instead of %d" % (self.structureName, self.structureVersion, recordStruct.size, self.size))
+        self.readRecordValues, self.recordValuesOf, self.recordReferences = builder.createFunctions()
+        self.recordStruct = recordStruct
+
+    def addFieldsToCodec(self, builder, ownerVariable, ownerExpression):
+        for field in self.fields:
+            field.addToCodec(builder, ownerVariable, ownerExpression)
+
     def createInstance(self, buffer=None, offset=0, checkExpectedValue=True):
-        return M3Structure(self, buffer, offset, checkExpectedValue)
+        return self.structureClass(buffer, offset, checkExpectedValue)
 
-    def createInstances(self, buffer, count, checkExpectedValue=True):
+    def createInstances(self, buffer, count, checkExpectedValue=True, references=None):
         if self.isPrimitive:
             if self.structureName == "CHAR":
-                return buffer[:count - 1].decode("ASCII", "replace")
+                return str(buffer[:count - 1], "ASCII", "replace")
             elif self.structureName == "U8__":
                 return bytearray(buffer[:count])
             else:
-                structFormat = self.fields[0].structFormat
-                list = []
-                for offset in range(0, count * self.size, self.size):
-                    bytesOfOneEntry = buffer[offset:(offset + self.size)]
-                    intValue = structFormat.unpack(bytesOfOneEntry)[0]
-                    list.append(intValue)
-                return list
+                return self.primitivesFromBuffer(buffer, count)
         else:
+            if self.recordStruct is None:
+                self.compileRecordCodec()
+            readRecordValues = self.readRecordValues
+            structureClass = self.structureClass
+            recordReferences = self.recordReferences
             list = []
-            instanceOffset = 0
-            for i in range(count):
-                list.append(self.createInstance(buffer=buffer, offset=instanceOffset, checkExpectedValue=checkExpectedValue))
-                instanceOffset += self.size
+            if references is not None and recordReferences is not None:
+                size = self.size
+                for recordIndex, values in enumerate(self.recordStruct.iter_unpack(memoryview(buffer)[:count * self.size])):
+                    instance = structureClass.__new__(structureClass)
+                    readRecordValues(instance, values, checkExpectedValue)
+                    recordReferences(values, recordIndex * size, references)
+                    list.append(instance)
+                return list
+            for values in self.recordStruct.iter_unpack(memoryview(buffer)[:count * self.size]):
+                instance = structureClass.__new__(structureClass)
+                readRecordValues(instance, values, checkExpectedValue)
+                list.append(instance)
             return list
 
+    def primitivesFromBuffer(self, buffer, count):
+        """ Decodes all entries of a primitive section like I32_ or REAL at once into a list """
+        typeCode = self.fields[0].structFormat.format[1:]
+        data = memoryview(buffer)[:count * self.size]
+        numpy = getNumpy()
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype="<" + typeCode).tolist()
+        values = array.array(typeCode)
+        values.frombytes(data)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values.tolist()
+
+    def primitivesToBytes(self, instances):
+        typeCode = self.fields[0].structFormat.format[1:]
+        values = array.array(typeCode, instances)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return bytearray(values)
+
+    def rawColumnFormats(self):
+        """ Returns a (column name, struct format character) pair for each primitive value of a record in storage order.
+        Embedded structures get flattened to names like "position.x" and fixed8 values stay raw bytes,
+        so that records can be stored losslessly as columns """
+        columnFormats = []
+        for field in self.fields:
+            field.addRawColumnFormats(columnFormats, "")
+        return columnFormats
+
+    def bytesToRawColumns(self, buffer):
+        """ Returns a list of values per column of rawColumnFormats for the records in the buffer """
+        columnFormats = self.rawColumnFormats()
+        buffer = memoryview(buffer)
+        if len(buffer) % self.size != 0:
+            raise Exception("%d bytes are not a multiple of the %s size %d" % (len(buffer), self.structureName, self.size))
+        numpy = getNumpy()
+        if numpy is not None:
+            records = numpy.frombuffer(buffer, dtype=self.rawColumnsDataType(numpy, columnFormats))
+            return [records[columnName].tolist() for columnName, formatChar in columnFormats]
+        columns = [[] for columnFormat in columnFormats]
+        recordStruct = struct.Struct("<" + "".join(formatChar for columnName, formatChar in columnFormats))
+        for columnIndex, column in enumerate(zip(*recordStruct.iter_unpack(buffer))):
+            columns[columnIndex] = list(column)
+        return columns
+
+    def rawColumnsToBytes(self, columns):
+        """ Inverse of bytesToRawColumns """
+        columnFormats = self.rawColumnFormats()
+        if len(columns) != len(columnFormats):
+            raise Exception("Expected %d columns for %s but got %d" % (len(columnFormats), self.structureName, len(columns)))
+        count = len(columns[0]) if len(columns) > 0 else 0
+        for (columnName, formatChar), column in zip(columnFormats, columns):
+            if len(column) != count:
+                raise Exception("Column %s of %s has %d instead of %d values" % (columnName, self.structureName, len(column), count))
+        numpy = getNumpy()
+        if numpy is not None:
+            records = numpy.empty(count, dtype=self.rawColumnsDataType(numpy, columnFormats))
+            for (columnName, formatChar), column in zip(columnFormats, columns):
+                records[columnName] = column
+            return bytearray(records.tobytes())
+        rawBytes = bytearray(count * self.size)
+        recordStruct = struct.Struct("<" + "".join(formatChar for columnName, formatChar in columnFormats))
+        offset = 0
+        for values in zip(*columns):
+            recordStruct.pack_into(rawBytes, offset, *values)
+            offset += self.size
+        return rawBytes
+
+    def rawColumnsDataType(self, numpy, columnFormats):
+        return numpy.dtype({"names": [columnName for columnName, formatChar in columnFormats], "formats": ["<" + formatChar for columnName, formatChar in columnFormats]})
+
     def dumpOffsets(self):
         offset = 0
         stderr.write("Offsets of %s in version %d:\n" % (self.structureName, self.structureVersion))
@@ -202,6 +450,23 @@ class M3StructureDescription:
                 raise
             field.validateContent(fieldContent, instanceName + "." + field.name)
 
+    def validateInstanceStructure(self, instance, instanceName):
+        """ Validates only the references and embedded structures of the instance, see the "structural" validation level """
+        for field in self.fields:
+            try:
+                fieldContent = getattr(instance, field.name)
+            except AttributeError:
+                raise Exception("%s does not have a field called %s" % (instanceName, field.name))
+            field.validateContentStructure(fieldContent, instanceName + "." + field.name)
+
+    def containsReferences(self):
+        for field in self.fields:
+            if isinstance(field, ReferenceField):
+                return True
+            if isinstance(field, EmbeddedStructureField) and field.structureDescription.containsReferences():
+                return True
+        return False
+
     def hasField(self, fieldName):
         return fieldName in self.nameToFieldMap
 
@@ -214,21 +479,30 @@ class M3StructureDescription:
             if type(instances) != bytes and type(instances) != bytearray:
                 raise Exception("Expected a byte array but it was a %s" % type(instances))
             return instances
+        elif self.isPrimitive:
+            return self.primitivesToBytes(instances)
         else:
             rawBytes = bytearray(self.size * len(instances))
-            offset = 0
-
-            if self.isPrimitive:
-                structFormat = self.fields[0].structFormat
-                for value in instances:
-                    structFormat.pack_into(rawBytes, offset, value)
-                    offset += self.size
-            else:
-                for value in instances:
-                    value.writeToBuffer(rawBytes, offset)
-                    offset += self.size
+            self.writeInstancesToBuffer(instances, rawBytes, 0)
             return rawBytes
 
+    def writeInstancesToBuffer(self, instances, buffer, offset):
+        """ Like instancesToBytes, but packs records directly into the buffer. Returns the offset after the instances """
+        if self.isPrimitive:
+            instanceBytes = self.instancesToBytes(instances)
+            end = offset + len(instanceBytes)
+            buffer[offset:end] = instanceBytes
+            return end
+        if self.recordStruct is None:
+            self.compileRecordCodec()
+        packInto = self.recordStruct.pack_into
+        recordValuesOf = self.recordValuesOf
+        size = self.size
+        for value in instances:
+            packInto(buffer, offset, *recordValuesOf(value))
+            offset += size
+        return offset
+
     def countBytesRequiredForInstances(self, instances):
         if self.structureName == "CHAR":
             return len(instances) + 1 # +1 for terminating character
@@ -236,10 +510,12 @@ class M3StructureDescription:
 
 
 class M3Structure:
+    """ Base class of the classes which M3StructureDescription generates for each structure version.
+    The generated classes provide the structureDescription as class attribute and a slot for each field """
 
-    def __init__(self, structureDescription, buffer=None, offset=0, checkExpectedValue=True):
-        self.structureDescription = structureDescription
+    __slots__ = ("lazyReferences", "lazySectionLoader", "loadedSection")
 
+    def __init__(self, buffer=None, offset=0, checkExpectedValue=True):
         if buffer is not None:
             self.readFromBuffer(buffer, offset, checkExpectedValue)
         else:
@@ -254,19 +530,40 @@ class M3Structure:
         for field in self.structureDescription.fields:
             field.resolveIndexReferences(self, sections)
 
-    def readFromBuffer(self, buffer, offset, checkExpectedValue):
-        fieldOffset = offset
+    def startChangeTracking(self, section):
+        self.loadedSection = section
         for field in self.structureDescription.fields:
-            field.readFromBuffer(self, buffer, fieldOffset, checkExpectedValue)
-            fieldOffset += field.size
-        assert fieldOffset - offset == self.structureDescription.size
+            field.startChangeTracking(self, section)
+        self.__class__ = self.structureDescription.getTrackedStructureClass()
 
-    def writeToBuffer(self, buffer, offset):
-        fieldOffset = offset
+    def prepareLazyReferences(self, sectionLoader):
+        lazyReferences = {}
         for field in self.structureDescription.fields:
-            field.writeToBuffer(self, buffer, fieldOffset)
-            fieldOffset += field.size
-        assert fieldOffset - offset == self.structureDescription.size
+            field.prepareLazyReference(self, sectionLoader, lazyReferences)
+        if len(lazyReferences) > 0:
+            self.lazyReferences = lazyReferences
+
+    def __getattr__(self, name):
+        # Only gets called for attributes which are not set, like the reference fields of lazily loaded models
+        if name != "lazyReferences":
+            lazyReferences = getattr(self, "lazyReferences", None)
+            if lazyReferences is not None and name in lazyReferences:
+                lazyReferences.pop(name).resolve(self)
+                return getattr(self, name)
+        raise AttributeError("%s object has no attribute %s" % (type(self).__name__, name))
+
+    def readFromBuffer(self, buffer, offset, checkExpectedValue):
+        structureDescription = self.structureDescription
+        if structureDescription.recordStruct is None:
+            structureDescription.compileRecordCodec()
+        values = structureDescription.recordStruct.unpack_from(buffer, offset)
+        structureDescription.readRecordValues(self, values, checkExpectedValue)
+
+    def writeToBuffer(self, buffer, offset):
+        structureDescription = self.structureDescription
+        if structureDescription.recordStruct is None:
+            structureDescription.compileRecordCodec()
+        structureDescription.recordStruct.pack_into(buffer, offset, *structureDescription.recordValuesOf(self))
 
     def __str__(self):
         fieldValueMap = {}
@@ -287,6 +584,86 @@ class M3Structure:
         return field.getBitNameMaskPairs()
 
 
+def setAttributeAndMarkSectionModified(instance, name, value):
+    object.__setattr__(instance, name, value)
+    instance.loadedSection.modified = True
+
+def tagFromBytes(b):
+    if b[3] == 0:
+        return b[2::-1].decode("latin-1")
+    else:
+        return b[::-1].decode("latin-1")
+
+
+def tagToBytes(s):
+    if len(s) == 4:
+        return (s[3] + s[2] + s[1] + s[0]).encode("ascii")
+    else:
+        return (s[2] + s[1] + s[0]).encode("ascii") + b"\x00"
+
+
+class RecordCodecBuilder:
+    """ Collects the flattened struct format and the source code of the functions which
+    convert between a M3Structure and the values of a single unpack/pack call """
+
+    def __init__(self):
+        self.formatCharacters = []
+        self.decodeLines = []
+        self.encodeExpressions = []
+        self.referenceExpressions = []
+        self.namespace = {"tagFromBytes": tagFromBytes, "tagToBytes": tagToBytes}
+        self.numberOfVariables = 0
+
+    def addValue(self, formatCharacters):
+        """ Returns the expression under which the decoder can access the new value """
+        valueIndex = len(self.formatCharacters)
+        self.formatCharacters.append(formatCharacters)
+        return "values[%d]" % valueIndex
+
+    def addConstant(self, value):
+        name = "constant%d" % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def newVariable(self):
+        self.numberOfVariables += 1
+        return "structure%d" % self.numberOfVariables
+
+    def addEmbeddedStructure(self, structureDescription, ownerVariable, ownerExpression, fieldName):
+        variable = self.newVariable()
+        structureClass = self.addConstant(structureDescription.structureClass)
+        self.decodeLines.append("%s = %s.__new__(%s)" % (variable, structureClass, structureClass))
+        structureDescription.addFieldsToCodec(self, variable, "%s.%s" % (ownerExpression, fieldName))
+        self.decodeLines.append("%s.%s = %s" % (ownerVariable, fieldName, variable))
+
+    def addReference(self, referenceStructureDescription, ownerVariable, ownerExpression, fieldName):
+        """ Like addEmbeddedStructure for a Reference or SmallReference, which also gets recorded by recordReferences """
+        offset = struct.calcsize(self.structFormatString())
+        firstValueIndex = len(self.formatCharacters)
+        self.addEmbeddedStructure(referenceStructureDescription, ownerVariable, ownerExpression, fieldName)
+        fieldNames = [field.name for field in referenceStructureDescription.fields]
+        if len(self.formatCharacters) - firstValueIndex != len(fieldNames):
+            raise Exception("Expected one value per field of %s" % referenceStructureDescription.structureName)
+        valueExpressions = {name: "values[%d]" % (firstValueIndex + fieldIndex) for fieldIndex, name in enumerate(fieldNames)}
+        fieldPath = self.addConstant(("%s.%s" % (ownerExpression, fieldName)).partition(".")[2])
+        self.referenceExpressions.append("(%s, %s, %s, recordOffset + %d, %s)" % (valueExpressions["index"], valueExpressions["entries"], valueExpressions.get("flags", "None"), offset, fieldPath))
+
+    def structFormatString(self):
+        return "<" + "".join(self.formatCharacters)
+
+    def createFunctions(self):
+        source = "def readRecordValues(instance, values, checkExpectedValue):\n"
+        for line in self.decodeLines:
+            source += "    " + line + "\n"
+        source += "def recordValuesOf(instance):\n"
+        source += "    return (%s,)\n" % ", ".join(self.encodeExpressions)
+        if len(self.referenceExpressions) > 0:
+            source += "def recordReferences(values, recordOffset, references):\n"
+            source += "    references.extend((%s,))\n" % ", ".join(self.referenceExpressions)
+        exec(source, self.namespace)
+        return self.namespace["readRecordValues"], self.namespace["recordValuesOf"], self.namespace.get("recordReferences")
+
+
 class Field:
     def __init__(self, name, sinceVersion, tillVersion):
         self.name = name
@@ -299,30 +676,40 @@ class Field:
     def resolveIndexReferences(self, owner, sections):
         pass
 
+    def prepareLazyReference(self, owner, sectionLoader, lazyReferences):
+        pass
+
+    def validateContentStructure(self, fieldContent, fieldPath):
+        """ Fields which are neither references nor embedded structures have no structure to validate """
+        pass
+
+    def addRawColumnFormats(self, columnFormats, prefix):
+        raise Exception("The field %s%s can't be stored as column" % (prefix, self.name))
+
+    def startChangeTracking(self, owner, section):
+        pass
+
+    def transferToOriginalRecord(self, source, originalRecord, sections):
+        """ Used by saveChangedModel to copy the current value to the decoded original record.
+        Returns False if the value requires a different section layout """
+        setattr(originalRecord, self.name, getattr(source, self.name))
+        return True
+
+    def addReferencedSectionIndices(self, owner, sectionIndices):
+        """ Adds the section index of the index reference in owner to sectionIndices if the field is a non-empty reference """
+        pass
+
 
 class TagField(Field):
 
     def __init__(self, name, sinceVersion, tillVersion):
         Field.__init__(self, name, sinceVersion, tillVersion)
-        self.structFormat = struct.Struct("<4B")
         self.size = 4
 
-    def readFromBuffer(self, owner, buffer, offset, checkExpectedValue):
-        b = self.structFormat.unpack_from(buffer, offset)
-        if b[3] == 0:
-            s = chr(b[2]) + chr(b[1]) + chr(b[0])
-        else:
-            s = chr(b[3]) + chr(b[2]) + chr(b[1]) + chr(b[0])
-
-        setattr(owner, self.name, s)
-
-    def writeToBuffer(self, owner, buffer, offset):
-        s = getattr(owner, self.name)
-        if len(s) == 4:
-            b = (s[3] + s[2] + s[1] + s[0]).encode("ascii")
-        else:
-            b = (s[2] + s[1] + s[0]).encode("ascii") + b"\x00"
-        return self.structFormat.pack_into(buffer, offset, b[0], b[1], b[2], b[3])
+    def addToCodec(self, builder, ownerVariable, ownerExpression):
+        valueExpression = builder.addValue("4s")
+        builder.decodeLines.append("%s.%s = tagFromBytes(%s)" % (ownerVariable, self.name, valueExpression))
+        builder.encodeExpressions.append("tagToBytes(%s.%s)" % (ownerExpression, self.name))
 
     def setToDefault(self, owner):
         pass
@@ -377,6 +764,37 @@ class ReferenceField(Field):
 
         setattr(owner, self.name, referencedObjects)
 
+    def validateContentStructure(self, fieldContent, fieldPath):
+        self.validateContent(fieldContent, fieldPath)
+
+    def transferToOriginalRecord(self, source, originalRecord, sections):
+        # The original record still has the index reference which got read from the file:
+        reference = getattr(originalRecord, self.name)
+        referencedObjects = getattr(source, self.name)
+        if reference.entries != 0 and referencedObjects is sections[reference.index].content:
+            return True
+        structureDescription = self.getListContentStructureDefinition(referencedObjects, self.name)
+        entries = 0 if structureDescription is None else structureDescription.countInstances(referencedObjects)
+        if entries == 0:
+            reference.entries = 0
+            return True
+        for sectionIndex, section in enumerate(sections):
+            if section.content is referencedObjects:
+                reference.entries = entries
+                reference.index = sectionIndex
+                return True
+        return False
+
+    def addReferencedSectionIndices(self, owner, sectionIndices):
+        reference = getattr(owner, self.name)
+        if reference.entries != 0:
+            sectionIndices.append(reference.index)
+
+    def prepareLazyReference(self, owner, sectionLoader, lazyReferences):
+        reference = getattr(owner, self.name)
+        delattr(owner, self.name)
+        lazyReferences[self.name] = LazyReference(self, reference, sectionLoader)
+
     def getListContentStructureDefinition(self, li, contextString):
 
         if self.historyOfReferencedStructures is None:
@@ -395,20 +813,15 @@ class ReferenceField(Field):
 
         firstElement = li[0]
         contentClass = type(firstElement)
-        if contentClass != M3Structure:
+        if not isinstance(firstElement, M3Structure):
             raise Exception("%s: Expected a list to contain an M3Structure object and not a %s" % (contextString, contentClass))
         # Optional: Enable check:
         # if not contentClass.tagName == tagName:
         #     raise Exception("Expected a list to contain a object of a class with tagName %s, but it contained a object of class %s with tagName %s" % (tagName, contentClass, contentClass.tagName))
         return firstElement.structureDescription
 
-    def readFromBuffer(self, owner, buffer, offset, checkExpectedValue):
-        referenceObject = self.referenceStructureDescription.createInstance(buffer, offset, checkExpectedValue)
-        setattr(owner, self.name, referenceObject)
-
-    def writeToBuffer(self, owner, buffer, offset):
-        referenceObject = getattr(owner, self.name)
-        referenceObject.writeToBuffer(buffer, offset)
+    def addToCodec(self, builder, ownerVariable, ownerExpression):
+        builder.addReference(self.referenceStructureDescription, ownerVariable, ownerExpression, self.name)
 
     def setToDefault(self, owner):
 
@@ -453,6 +866,10 @@ class RealReferenceField(ReferenceField):
                 itemPath = "%s[%d]" % (fieldPath, itemIndex)
                 raise Exception("%s is not an float" % (itemPath))
 
+    def validateContentStructure(self, fieldContent, fieldPath):
+        if not isinstance(fieldContent, list):
+            raise Exception("%s is not a list of float" % (fieldPath))
+
 
 class IntReferenceField(ReferenceField):
     intRefToMinValue = {"I16_": (-(1 << 15)), "U16_": 0, "I32_": (-(1 << 31)), "U32_": 0, "FLAG": 0}
@@ -473,6 +890,10 @@ class IntReferenceField(ReferenceField):
             if (item < self.minValue) or (item > self.maxValue):
                 raise Exception("%s has value %d which is not in range [%s, %s]"  % (itemPath, item, self.minValue, self.maxValue))
 
+    def validateContentStructure(self, fieldContent, fieldPath):
+        if not isinstance(fieldContent, list):
+            raise Exception("%s is not a list of integers" % (fieldPath))
+
 
 class StructureReferenceField(ReferenceField):
 
@@ -489,6 +910,16 @@ class StructureReferenceField(ReferenceField):
             for itemIndex, item in enumerate(fieldContent):
                 structureDescription.validateInstance(item, "%s[%d]" % (fieldPath, itemIndex))
 
+    def validateContentStructure(self, fieldContent, fieldPath):
+        if not isinstance(fieldContent, list):
+            raise Exception("%s is not a list, but a %s" % (fieldPath, type(fieldContent)))
+        if len(fieldContent) > 0:
+            structureDescription = self.getListContentStructureDefinition(fieldContent, fieldPath)
+            if structureDescription.history != self.historyOfReferencedStructures:
+                raise Exception("Expected that %s is a list of %s and not %s" % (fieldPath, self.historyOfReferencedStructures.name, structureDescription.history.name))
+            for itemIndex, item in enumerate(fieldContent):
+                structureDescription.validateInstanceStructure(item, "%s[%d]" % (fieldPath, itemIndex))
+
 class UnknownReferenceField(ReferenceField):
 
     def __init__(self, name, referenceStructureDescription, historyOfReferencedStructures, sinceVersion, tillVersion):
@@ -513,18 +944,38 @@ class EmbeddedStructureField(Field):
         emeddedStructure = getattr(owner, self.name)
         emeddedStructure.resolveReferences(sections)
 
-    def toBytes(self, owner):
+    def prepareLazyReference(self, owner, sectionLoader, lazyReferences):
         emeddedStructure = getattr(owner, self.name)
-        return emeddedStructure.toBytes()
+        emeddedStructure.prepareLazyReferences(sectionLoader)
+
+    def startChangeTracking(self, owner, section):
+        getattr(owner, self.name).startChangeTracking(section)
 
-    def readFromBuffer(self, owner, buffer, offset, checkExpectedValue):
+    def transferToOriginalRecord(self, source, originalRecord, sections):
+        embeddedStructure = getattr(source, self.name)
+        originalEmbeddedStructure = getattr(originalRecord, self.name)
+        if embeddedStructure.structureDescription is not self.structureDescription:
+            return False
+        for field in self.structureDescription.fields:
+            if not field.transferToOriginalRecord(embeddedStructure, originalEmbeddedStructure, sections):
+                return False
+        return True
 
-        referenceObject = self.structureDescription.createInstance(buffer, offset, checkExpectedValue)
-        setattr(owner, self.name, referenceObject)
+    def addReferencedSectionIndices(self, owner, sectionIndices):
+        embeddedStructure = getattr(owner, self.name)
+        for field in self.structureDescription.fields:
+            field.addReferencedSectionIndices(embeddedStructure, sectionIndices)
 
-    def writeToBuffer(self, owner, buffer, offset):
+    def toBytes(self, owner):
         emeddedStructure = getattr(owner, self.name)
-        emeddedStructure.writeToBuffer(buffer, offset)
+        return emeddedStructure.toBytes()
+
+    def addToCodec(self, builder, ownerVariable, ownerExpression):
+        builder.addEmbeddedStructure(self.structureDescription, ownerVariable, ownerExpression, self.name)
+
+    def addRawColumnFormats(self, columnFormats, prefix):
+        for field in self.structureDescription.fields:
+            field.addRawColumnFormats(columnFormats, prefix + self.name + ".")
 
     def setToDefault(self, owner):
         v = self.structureDescription.createInstance()
@@ -533,6 +984,9 @@ class EmbeddedStructureField(Field):
     def validateContent(self, fieldContent, fieldPath):
         self.structureDescription.validateInstance(fieldContent, fieldPath)
 
+    def validateContentStructure(self, fieldContent, fieldPath):
+        self.structureDescription.validateInstanceStructure(fieldContent, fieldPath)
+
 
 class PrimitiveField(Field):
     """ Base class for IntField and FloatField """
@@ -545,17 +999,21 @@ class PrimitiveField(Field):
         self.defaultValue = defaultValue
         self.expectedValue = expectedValue
 
-    def readFromBuffer(self, owner, buffer, offset, checkExpectedValue):
-        value = self.structFormat.unpack_from(buffer, offset)[0]
-        if self.expectedValue is not None and value != self.expectedValue:
-            structureName = owner.structureDescription.structureName
-            structureVersion = owner.structureDescription.structureVersion
-            raise Exception("Expected that field %s of %s (V. %d) has always the value %s, but it was %s" % (self.name, structureName, structureVersion, self.expectedValue, value))
-        setattr(owner, self.name, value)
+    def addToCodec(self, builder, ownerVariable, ownerExpression):
+        valueExpression = builder.addValue(primitiveFieldTypeFormats[self.typeString])
+        builder.decodeLines.append("%s.%s = %s" % (ownerVariable, self.name, valueExpression))
+        if self.expectedValue is not None:
+            builder.decodeLines.append("if checkExpectedValue and %s != %s:" % (valueExpression, builder.addConstant(self.expectedValue)))
+            builder.decodeLines.append("    %s.raiseUnexpectedValue(%s, %s)" % (builder.addConstant(self), ownerVariable, valueExpression))
+        builder.encodeExpressions.append("%s.%s" % (ownerExpression, self.name))
+
+    def addRawColumnFormats(self, columnFormats, prefix):
+        columnFormats.append((prefix + self.name, primitiveFieldTypeFormats[self.typeString]))
 
-    def writeToBuffer(self, owner, buffer, offset):
-        value = getattr(owner, self.name)
-        return self.structFormat.pack_into(buffer, offset, value)
+    def raiseUnexpectedValue(self, owner, value):
+        structureName = owner.structureDescription.structureName
+        structureVersion = owner.structureDescription.structureVersion
+        raise Exception("Expected that field %s of %s (V. %d) has always the value %s, but it was %s" % (self.name, structureName, structureVersion, self.expectedValue, value))
 
     def setToDefault(self, owner):
         setattr(owner, self.name, self.defaultValue)
@@ -607,20 +1065,13 @@ class Fixed8Field(PrimitiveField):
     def __init__(self, name, typeString, sinceVersion, tillVersion, defaultValue, expectedValue):
         PrimitiveField.__init__(self, name, typeString, sinceVersion, tillVersion, defaultValue, expectedValue)
 
-    def readFromBuffer(self, owner, buffer, offset, checkExpectedValue):
-        intValue = self.structFormat.unpack_from(buffer, offset)[0]
-        floatValue = ((intValue / 255.0 * 2.0) - 1)
-
-        if checkExpectedValue and self.expectedValue is not None and floatValue != self.expectedValue:
-            structureName = owner.structureDescription.structureName
-            structureVersion = owner.structureDescription.structureVersion
-            raise Exception("Expected that field %s of %s (V. %d) has always the value %s, but it was %s" % (self.name, structureName, structureVersion, self.expectedValue, intValue))
-        setattr(owner, self.name, floatValue)
-
-    def writeToBuffer(self, owner, buffer, offset):
-        floatValue = getattr(owner, self.name)
-        intValue = round((floatValue + 1) / 2.0 * 255.0)
-        return self.structFormat.pack_into(buffer, offset, intValue)
+    def addToCodec(self, builder, ownerVariable, ownerExpression):
+        valueExpression = builder.addValue("B")
+        builder.decodeLines.append("%s.%s = ((%s / 255.0 * 2.0) - 1)" % (ownerVariable, self.name, valueExpression))
+        if self.expectedValue is not None:
+            builder.decodeLines.append("if checkExpectedValue and %s.%s != %s:" % (ownerVariable, self.name, builder.addConstant(self.expectedValue)))
+            builder.decodeLines.append("    %s.raiseUnexpectedValue(%s, %s)" % (builder.addConstant(self), ownerVariable, valueExpression))
+        builder.encodeExpressions.append("round((%s.%s + 1) / 2.0 * 255.0)" % (ownerExpression, self.name))
 
     def validateContent(self, fieldContent, fieldPath):
         if (type(fieldContent) != float):
@@ -637,16 +1088,16 @@ class UnknownBytesField(Field):
         self.expectedValue = expectedValue
         assert self.structFormat.size == self.size
 
-    def readFromBuffer(self, owner, buffer, offset, checkExpectedValue):
-        value = self.structFormat.unpack_from(buffer, offset)[0]
-        if checkExpectedValue and self.expectedValue is not None and value != self.expectedValue:
-            raise Exception("Expected that %sV%s.%s has always the value %s, but it was %s" % (owner.structureDescription.structureName, owner.structureDescription.structureVersion, self.name, self.expectedValue, value))
+    def addToCodec(self, builder, ownerVariable, ownerExpression):
+        valueExpression = builder.addValue("%ss" % self.size)
+        builder.decodeLines.append("%s.%s = %s" % (ownerVariable, self.name, valueExpression))
+        if self.expectedValue is not None:
+            builder.decodeLines.append("if checkExpectedValue and %s != %s:" % (valueExpression, builder.addConstant(self.expectedValue)))
+            builder.decodeLines.append("    %s.raiseUnexpectedValue(%s, %s)" % (builder.addConstant(self), ownerVariable, valueExpression))
+        builder.encodeExpressions.append("%s.%s" % (ownerExpression, self.name))
 
-        setattr(owner, self.name, value)
-
-    def writeToBuffer(self, owner, buffer, offset):
-        value = getattr(owner, self.name)
-        return self.structFormat.pack_into(buffer, offset, value)
+    def raiseUnexpectedValue(self, owner, value):
+        raise Exception("Expected that %sV%s.%s has always the value %s, but it was %s" % (owner.structureDescription.structureName, owner.structureDescription.structureVersion, self.name, self.expectedValue, value))
 
     def setToDefault(self, owner):
         setattr(owner, self.name, self.defaultValue)
@@ -876,6 +1327,29 @@ class BitMaskMapDeterminer(Visitor):
         bitMaskMap[bitName] = bitMask
 
 
+class SchemaCacheRecorder(Visitor):
+    """ Records the data maps determined by the reading visitors without their xml nodes,
+    so that FieldListCreator and StructureHistoryListCreator can be run later without the xml file """
+
+    def visitStart(self, generalDataMap):
+        generalDataMap["schemaCacheData"] = []
+
+    def visitClassStart(self, generalDataMap, classDataMap):
+        classDataMap["recordedFieldDataMaps"] = []
+
+    def visitFieldEnd(self, generalDataMap, classDataMap, fieldDataMap):
+        recordedFieldDataMap = dict(fieldDataMap)
+        del recordedFieldDataMap["xmlNode"]
+        classDataMap["recordedFieldDataMaps"].append(recordedFieldDataMap)
+
+    def visitClassEnd(self, generalDataMap, classDataMap):
+        recordedClassDataMap = dict(classDataMap)
+        del recordedClassDataMap["xmlNode"]
+        del recordedClassDataMap["recordedFieldDataMaps"]
+        recordedClassDataMap.pop("fields", None)
+        generalDataMap["schemaCacheData"].append((recordedClassDataMap, classDataMap["recordedFieldDataMaps"]))
+
+
 class FieldListCreator(Visitor):
     def visitClassStart(self, generalDataMap, classDataMap):
         classDataMap["fields"] = []
@@ -1019,8 +1493,32 @@ def visitStructresDomWith(structuresDom, visitors, generalDataMap):
     for visitor in visitors:
         visitor.visitEnd(generalDataMap)
 
+def visitSchemaCacheDataWith(schemaCacheData, visitors, generalDataMap):
+    for visitor in visitors:
+        visitor.visitStart(generalDataMap)
+
+    for recordedClassDataMap, recordedFieldDataMaps in schemaCacheData:
+        classDataMap = dict(recordedClassDataMap)
+        for visitor in visitors:
+            visitor.visitClassStart(generalDataMap, classDataMap)
+
+        for recordedFieldDataMap in recordedFieldDataMaps:
+            fieldDataMap = dict(recordedFieldDataMap)
+            for visitor in visitors:
+                visitor.visitFieldStart(generalDataMap, classDataMap, fieldDataMap)
+            for visitor in visitors:
+                visitor.visitFieldEnd(generalDataMap, classDataMap, fieldDataMap)
+
+        for visitor in visitors:
+            visitor.visitClassEnd(generalDataMap, classDataMap)
+
+    for visitor in visitors:
+        visitor.visitEnd(generalDataMap)
+
 def readStructureDefinitions(structuresXmlFile):
-    doc = xml.dom.minidom.parse(structuresXmlFile)
+    return readStructureDefinitionsFromDom(xml.dom.minidom.parse(structuresXmlFile))["structures"]
+
+def readStructureDefinitionsFromDom(doc):
     generalDataMap = {}
 
     # first run is only for determing the complete list of known structures
@@ -1038,15 +1536,90 @@ def readStructureDefinitions(structuresXmlFile):
         ExpectedAndDefaultConstantsDeterminer(),
         BitAttributesReader(),
         BitMaskMapDeterminer(),
+        SchemaCacheRecorder(),
         FieldListCreator(),
         StructureHistoryListCreator()
     ]
 
     visitStructresDomWith(doc, secondRunVisitors, generalDataMap)
 
+    return generalDataMap
+
+
+schemaCacheFormatVersion = 2
+
+def loadSchemaCache(schemaCachePath, schemaSourceHash):
+    """ Returns the recorded schema data or None if the cache is missing, unreadable or stale """
+    try:
+        with open(schemaCachePath, "rb") as schemaCacheFile:
+            schemaCache = pickle.load(schemaCacheFile)
+    except Exception:
+        return None
+    if not isinstance(schemaCache, dict):
+        return None
+    if schemaCache.get("formatVersion") != schemaCacheFormatVersion or schemaCache.get("schemaSourceHash") != schemaSourceHash:
+        return None
+    return schemaCache.get("schemaCacheData")
+
+def saveSchemaCache(schemaCachePath, schemaSourceHash, schemaCacheData):
+    schemaCache = {"formatVersion": schemaCacheFormatVersion, "schemaSourceHash": schemaSourceHash, "schemaCacheData": schemaCacheData}
+    temporaryPath = "%s.%d.tmp" % (schemaCachePath, os.getpid())
+    try:
+        with open(temporaryPath, "wb") as schemaCacheFile:
+            pickle.dump(schemaCache, schemaCacheFile, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporaryPath, schemaCachePath)
+    except OSError:
+        # e.g. the add-on directory is read only: the xml file gets parsed again next time
+        try:
+            os.remove(temporaryPath)
+        except OSError:
+            pass
+
+def readStructureDefinitionsWithCache(structuresXmlPath, schemaCachePath, schemaCodePaths=()):
+    """ Like readStructureDefinitions, but uses a cache of the parsed xml file. The cache is keyed by the hash of the
+    content of the xml file and of the files in schemaCodePaths, which contain the code that reads the schema,
+    so that changes of for example the default values don't reuse a stale cache """
+    with open(structuresXmlPath, "rb") as structuresXmlFile:
+        structuresXmlBytes = structuresXmlFile.read()
+    hasher = hashlib.sha256(structuresXmlBytes)
+    for schemaCodePath in schemaCodePaths:
+        with open(schemaCodePath, "rb") as schemaCodeFile:
+            hasher.update(schemaCodeFile.read())
+    schemaSourceHash = hasher.hexdigest()
+
+    schemaCacheData = loadSchemaCache(schemaCachePath, schemaSourceHash)
+    if schemaCacheData is not None:
+        generalDataMap = {}
+        visitors = [FieldListCreator(), StructureHistoryListCreator()]
+        visitSchemaCacheDataWith(schemaCacheData, visitors, generalDataMap)
+        return generalDataMap["structures"]
+
+    generalDataMap = readStructureDefinitionsFromDom(xml.dom.minidom.parseString(structuresXmlBytes))
+    saveSchemaCache(schemaCachePath, schemaSourceHash, generalDataMap["schemaCacheData"])
     return generalDataMap["structures"]
 
 
+validationLevels = ("off", "structural", "full")
+""" The validation levels of loadModel, loadSections and saveAndInvalidateModel:
+  * off: Nothing gets checked that isn't required to read or write the file
+  * structural: Checks that all sections got referenced on load and that the references
+    and embedded structures of a model are of the expected types before saving it
+  * full: Checks in addition the expected values while loading and all field values """
+
+def checkValidationLevel(validation):
+    if validation not in validationLevels:
+        raise Exception("Unknown validation level %s, expected one of %s" % (validation, ", ".join(validationLevels)))
+
+def validateModel(model, validation="full"):
+    """ Validates a complete model tree in a separate pass, so that it can also be done after loading or before saving """
+    checkValidationLevel(validation)
+    modelDescription = model.structureDescription
+    if validation == "full":
+        modelDescription.validateInstance(model, "model")
+    elif validation == "structural":
+        modelDescription.validateInstanceStructure(model, "model")
+
+
 def resolveAllReferences(list, sections):
     ListType = type([])
     for sublist in list:
@@ -1054,65 +1627,131 @@ def resolveAllReferences(list, sections):
             for entry in sublist:
                 entry.resolveReferences(sections)
 
-def loadSections(filename, checkExpectedValue=True):
-    source = open(filename, "rb")
-    try:
-        MD34V11 = structures["MD34"].getVersion(11)
-        headerBytes = source.read(MD34V11.size)
-        header = MD34V11.createInstance(headerBytes, checkExpectedValue=checkExpectedValue)
-
-        source.seek(header.indexOffset)
-        MD34IndexEntryV0 = structures["MD34IndexEntry"].getVersion(0)
-        sections = []
-        for i in range(header.indexSize):
-            section = Section()
-            indexEntryBytes = source.read(MD34IndexEntryV0.size)
-            section.indexEntry = MD34IndexEntryV0.createInstance(indexEntryBytes, checkExpectedValue=checkExpectedValue)
-            sections.append(section)
+def openModelBuffer(source, memoryMap=False):
+    """ Returns a memoryview of the content of an m3 file.
+
+    source can be a file name, an open binary file or an object which supports the
+    buffer protocol like bytes, bytearray or mmap. When memoryMap is True, files
+    get memory mapped copy-on-write instead of being read, so that the sections
+    get decoded directly from the page cache."""
+    if isinstance(source, str):
+        with open(source, "rb") as fileObject:
+            return openModelBuffer(fileObject, memoryMap)
+    elif hasattr(source, "read"):
+        if memoryMap:
+            return memoryview(mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_COPY))
+        else:
+            return memoryview(source.read())
+    else:
+        return memoryview(source)
 
-        offsets = []
-        for section in sections:
-            indexEntry = section.indexEntry
-            offsets.append(indexEntry.offset)
-        offsets.append(header.indexOffset)
-        offsets.sort()
-        previousOffset = offsets[0]
-        offsetToSizeMap = {}
-        for offset in offsets[1:]:
-            offsetToSizeMap[previousOffset] = offset - previousOffset
-            previousOffset = offset
-
-        unknownSections = set()
-        for section in sections:
-            indexEntry = section.indexEntry
-            source.seek(indexEntry.offset)
-            numberOfBytes = offsetToSizeMap[indexEntry.offset]
-            section.rawBytes = source.read(numberOfBytes)
-
-            structureHistory = structures.get(indexEntry.tag)
-            if structureHistory is not None:
-                structureDescription = structureHistory.getVersion(indexEntry.version)
-            else:
-                structureDescription = None
+def scanIndex(filename):
+    """ Reads only the MD34 header and the index table of an m3 file, so that it also works for unknown structures.
+    Returns a dictionary with the file size, a list of sections with their tag, version, repetitions, offset and size
+    in bytes, and a per tag breakdown of these numbers with a further breakdown per version """
+    MD34V11 = structures["MD34"].getVersion(11)
+    MD34IndexEntryV0 = structures["MD34IndexEntry"].getVersion(0)
+    with open(filename, "rb") as fileObject:
+        headerBytes = fileObject.read(MD34V11.size)
+        if len(headerBytes) < MD34V11.size:
+            raise Exception("%s is too small to be an m3 file" % filename)
+        header = MD34V11.createInstance(headerBytes, checkExpectedValue=False)
+        if header.tag != "MD34":
+            raise Exception("%s is not an m3 file: It starts with %s instead of MD34" % (filename, header.tag))
+        fileSize = fileObject.seek(0, os.SEEK_END)
+        indexByteSize = header.indexSize * MD34IndexEntryV0.size
+        if header.indexOffset + indexByteSize > fileSize:
+            raise Exception("The index of %s with %d entries at offset %d exceeds the file size %d" % (filename, header.indexSize, header.indexOffset, fileSize))
+        fileObject.seek(header.indexOffset)
+        indexBytes = fileObject.read(indexByteSize)
+    indexEntries = MD34IndexEntryV0.createInstances(indexBytes, header.indexSize, checkExpectedValue=False)
+
+    boundaries = sorted(set([indexEntry.offset for indexEntry in indexEntries] + [header.indexOffset, fileSize]))
+    offsetToSizeMap = {}
+    for offset, nextOffset in zip(boundaries, boundaries[1:]):
+        offsetToSizeMap[offset] = nextOffset - offset
+
+    sections = []
+    tags = {}
+    for indexEntry in indexEntries:
+        size = offsetToSizeMap.get(indexEntry.offset, 0)
+        sections.append({"tag": indexEntry.tag, "version": indexEntry.version, "repetitions": indexEntry.repetitions, "offset": indexEntry.offset, "size": size})
+        structureHistory = structures.get(indexEntry.tag)
+        tagSummary = tags.get(indexEntry.tag)
+        if tagSummary is None:
+            tagSummary = {"known": structureHistory is not None, "sections": 0, "repetitions": 0, "bytes": 0, "versions": {}}
+            tags[indexEntry.tag] = tagSummary
+        versionSummary = tagSummary["versions"].get(indexEntry.version)
+        if versionSummary is None:
+            versionKnown = structureHistory is not None and indexEntry.version in structureHistory.versionToSizeMap
+            versionSummary = {"known": versionKnown, "sections": 0, "repetitions": 0, "bytes": 0}
+            tagSummary["versions"][indexEntry.version] = versionSummary
+        for summary in (tagSummary, versionSummary):
+            summary["sections"] += 1
+            summary["repetitions"] += indexEntry.repetitions
+            summary["bytes"] += size
+    return {"file": filename, "fileSize": fileSize, "indexOffset": header.indexOffset, "sections": sections, "tags": tags}
+
+def loadSections(source, checkExpectedValue=True, memoryMap=False, lazy=False, validation="full"):
+    """ source can be a file name, an open binary file or a buffer, see openModelBuffer.
+    The rawBytes of the sections are memoryview slices of a single buffer of the whole file.
+    When lazy is True, the content field of the sections does not get determined.
+    Expected values get only checked at the validation level "full", see validationLevels."""
+    checkValidationLevel(validation)
+    checkExpectedValue = checkExpectedValue and validation == "full"
+    buffer = openModelBuffer(source, memoryMap)
+    MD34V11 = structures["MD34"].getVersion(11)
+    header = MD34V11.createInstance(buffer, checkExpectedValue=checkExpectedValue)
+
+    MD34IndexEntryV0 = structures["MD34IndexEntry"].getVersion(0)
+    indexEntries = MD34IndexEntryV0.createInstances(buffer[header.indexOffset:], header.indexSize, checkExpectedValue=checkExpectedValue)
+    sections = []
+    for indexEntry in indexEntries:
+        section = Section()
+        section.indexEntry = indexEntry
+        sections.append(section)
+
+    offsets = []
+    for section in sections:
+        indexEntry = section.indexEntry
+        offsets.append(indexEntry.offset)
+    offsets.append(header.indexOffset)
+    offsets.sort()
+    previousOffset = offsets[0]
+    offsetToSizeMap = {}
+    for offset in offsets[1:]:
+        offsetToSizeMap[previousOffset] = offset - previousOffset
+        previousOffset = offset
+
+    unknownSections = set()
+    for section in sections:
+        indexEntry = section.indexEntry
+        numberOfBytes = offsetToSizeMap[indexEntry.offset]
+        section.rawBytes = buffer[indexEntry.offset:indexEntry.offset + numberOfBytes]
 
-            if structureDescription is not None:
-                section.structureDescription = structureDescription
+        structureHistory = structures.get(indexEntry.tag)
+        if structureHistory is not None:
+            structureDescription = structureHistory.getVersion(indexEntry.version)
+        else:
+            structureDescription = None
+
+        if structureDescription is not None:
+            section.structureDescription = structureDescription
+            if not lazy:
                 section.determineContentField(checkExpectedValue)
-            else:
-                guessedUnusedSectionBytes = 0
-                for i in range(1, 16):
-                    if section.rawBytes[len(section.rawBytes) - i] == 0xaa:
-                        guessedUnusedSectionBytes += 1
-                    else:
-                        break
-                guessedBytesPerEntry = float(len(section.rawBytes) - guessedUnusedSectionBytes) / indexEntry.repetitions
-                message = "ERROR: Unknown section at offset %s with tag=%s version=%s repetitions=%s sectionLengthInBytes=%s guessedUnusedSectionBytes=%s guessedBytesPerEntry=%s\n" % (indexEntry.offset, indexEntry.tag, indexEntry.version, indexEntry.repetitions, len(section.rawBytes), guessedUnusedSectionBytes, guessedBytesPerEntry)
-                stderr.write(message)
-                unknownSections.add("%sV%s" % (indexEntry.tag, indexEntry.version))
-        if len(unknownSections) != 0:
-            raise Exception("There were %s unknown sections: %s (see console log for more details)" % (len(unknownSections), unknownSections))
-    finally:
-        source.close()
+        else:
+            guessedUnusedSectionBytes = 0
+            for i in range(1, 16):
+                if section.rawBytes[len(section.rawBytes) - i] == 0xaa:
+                    guessedUnusedSectionBytes += 1
+                else:
+                    break
+            guessedBytesPerEntry = float(len(section.rawBytes) - guessedUnusedSectionBytes) / indexEntry.repetitions
+            message = "ERROR: Unknown section at offset %s with tag=%s version=%s repetitions=%s sectionLengthInBytes=%s guessedUnusedSectionBytes=%s guessedBytesPerEntry=%s\n" % (indexEntry.offset, indexEntry.tag, indexEntry.version, indexEntry.repetitions, len(section.rawBytes), guessedUnusedSectionBytes, guessedBytesPerEntry)
+            stderr.write(message)
+            unknownSections.add("%sV%s" % (indexEntry.tag, indexEntry.version))
+    if len(unknownSections) != 0:
+        raise Exception("There were %s unknown sections: %s (see console log for more details)" % (len(unknownSections), unknownSections))
     return sections
 
 def resolveReferencesOfSections(sections):
@@ -1120,57 +1759,419 @@ def resolveReferencesOfSections(sections):
         section.resolveReferences(sections)
 
 def checkThatAllSectionsGotReferenced(sections):
-    numberOfUnreferencedSections = 0
-    referenceStructureDescription = reference = structures["Reference"].getVersion(0)
+    unreferencedSectionIndices = []
     for sectionIndex, section in enumerate(sections):
-
         if (section.timesReferenced == 0) and (sectionIndex != 0):
-            numberOfUnreferencedSections += 1
-            stderr.write("WARNING: %sV%s (%d repetitions) got %d times referenced\n" % (section.indexEntry.tag, section.indexEntry.version, section.indexEntry.repetitions, section.timesReferenced))
-            reference = referenceStructureDescription.createInstance()
-            reference.entries = section.indexEntry.repetitions
-            reference.index = sectionIndex
-            reference.flags = 0
-            bytesToSearch = referenceStructureDescription.instancesToBytes([reference])
-            possibleReferences = 0
-            for sectionToCheck in sections:
-                positionInSection = sectionToCheck.rawBytes.find(bytesToSearch)
-                if positionInSection != -1:
-                    possibleReferences += 1
-                    stderr.write("  -> Found a reference at offset %d in a section of type %sV%s\n" % (positionInSection % sectionToCheck.structureDescription.size, sectionToCheck.indexEntry.tag, sectionToCheck.indexEntry.version))
-                    sectionToCheck.structureDescription.dumpOffsets()
-
-            if possibleReferences == 0:
-                bytesToSearch = bytesToSearch[0:-4]
-                for sectionToCheck in sections:
-                    positionInSection = sectionToCheck.rawBytes.find(bytesToSearch)
-                    if positionInSection != -1:
-                        flagBytes = sectionToCheck.rawBytes[positionInSection + 8:positionInSection + 12]
-                        flagsAsHex = ''.join(["%02x" % x for x in flagBytes])
-                        stderr.write("  -> Found maybe a reference at offset %d in a section of type %sV%s with flag %s\n" % (positionInSection, sectionToCheck.indexEntry.tag, sectionToCheck.indexEntry.version, flagsAsHex))
-                        sectionToCheck.structureDescription.dumpOffsets()
-
-    if numberOfUnreferencedSections > 0:
-        raise Exception("Unable to load all data: There were %d unreferenced sections. View log for details" % numberOfUnreferencedSections)
-
-def loadModel(filename, checkExpectedValue=True):
-    sections = loadSections(filename, checkExpectedValue)
+            unreferencedSectionIndices.append(sectionIndex)
+    if len(unreferencedSectionIndices) == 0:
+        return
+
+    referencesToSectionMap = {sectionIndex: [] for sectionIndex in unreferencedSectionIndices}
+    for sectionToCheck in sections:
+        for reference in sectionToCheck.determineReferences():
+            referencesToSection = referencesToSectionMap.get(reference[0])
+            if referencesToSection is not None:
+                referencesToSection.append((sectionToCheck, reference))
+    for sectionIndex in unreferencedSectionIndices:
+        section = sections[sectionIndex]
+        stderr.write("WARNING: %sV%s (%d repetitions) got %d times referenced\n" % (section.indexEntry.tag, section.indexEntry.version, section.indexEntry.repetitions, section.timesReferenced))
+        for sectionToCheck, (index, entries, flags, offset, fieldPath) in referencesToSectionMap[sectionIndex]:
+            structureDescription = sectionToCheck.structureDescription
+            flagsDescription = "" if flags is None else " and flags 0x%08x" % flags
+            stderr.write("  -> Field %s of record %d in a section of type %sV%s (offset %d) references it with %d entries%s\n" % (fieldPath, offset // structureDescription.size, sectionToCheck.indexEntry.tag, sectionToCheck.indexEntry.version, offset, entries, flagsDescription))
+
+    raise Exception("Unable to load all data: There were %d unreferenced sections. View log for details" % len(unreferencedSectionIndices))
+
+def loadModel(filename, checkExpectedValue=True, memoryMap=False, lazy=False, validation="full", trackChanges=False):
+    """ When lazy is True, sections get only decoded when a reference to them gets accessed for the first time.
+    The check for unreferenced sections and the validation get skipped then, see checkLazilyLoadedModel.
+
+    When trackChanges is True, the original bytes of the sections are kept and setting a field of a structure
+    marks its section as modified, so that saveChangedModel can re-encode only the modified sections.
+
+    At the validation level "structural" only the check for unreferenced sections is performed, since the
+    structure of a decoded model is correct by construction. See validationLevels for the other levels."""
+    checkValidationLevel(validation)
+    if lazy and trackChanges:
+        raise Exception("Changes of lazily loaded models can't be tracked")
+    sections = loadSections(filename, checkExpectedValue, memoryMap, lazy, validation)
+    if lazy:
+        sectionLoader = LazySectionLoader(sections, checkExpectedValue and validation == "full")
+        sectionLoader.determineContentOfSection(0)
+        header = sections[0].content[0]
+        model = header.model[0]
+        model.lazySectionLoader = sectionLoader
+        return model
     resolveReferencesOfSections(sections)
-    checkThatAllSectionsGotReferenced(sections)
+    if validation != "off":
+        checkThatAllSectionsGotReferenced(sections)
     header = sections[0].content[0]
     model = header.model[0]
-    modelDescription = model.structureDescription
-    modelDescription.validateInstance(model, "model")
+    if validation == "full":
+        validateModel(model, validation)
+    if trackChanges:
+        for section in sections:
+            section.startChangeTracking(sections)
     return model
 
+def checkLazilyLoadedModel(model, validation="full"):
+    """ Performs the checks that loadModel skipped for a model loaded with lazy=True: Decodes all remaining sections,
+    validates the model and checks that all sections got referenced """
+    checkValidationLevel(validation)
+    # Both validation levels access every reference and thus decode all remaining sections:
+    validateModel(model, validation)
+    if validation != "off":
+        checkThatAllSectionsGotReferenced(model.lazySectionLoader.sections)
+
+
+queryPathPartPattern = re.compile(r"^(\w+)((?:\[(?:\*|-?\d+)\])*)$")
+queryIndexPattern = re.compile(r"\[(\*|-?\d+)\]")
+
+class QueryList:
+    """ The referenced records of a reference field in a ModelQuery. The records get only decoded when they are needed """
+
+    def __init__(self, modelQuery, sectionIndex, entries):
+        self.modelQuery = modelQuery
+        self.sectionIndex = sectionIndex
+        self.entries = entries
+
+    def get(self, recordIndex):
+        if recordIndex < 0:
+            recordIndex += self.entries
+        if recordIndex < 0 or recordIndex >= self.entries:
+            raise IndexError("Index %d is out of range for a list with %d entries" % (recordIndex, self.entries))
+        return self.modelQuery.recordAt(self.sectionIndex, recordIndex)
+
+    def getAll(self):
+        return [self.modelQuery.recordAt(self.sectionIndex, recordIndex) for recordIndex in range(self.entries)]
+
+
+class ModelQuery:
+    """ Answers queries like "model.bones[*].name" or "LAYR.imagePath" by decoding only the records on the path.
+    Paths start either with "model" or with the tag of a structure, which matches all records with that tag.
+    After each field name one or more indices like [2], [-1] or the wildcard [*] can select list elements.
+    Structures in the result are loaded lazily, see loadModel """
+
+    def __init__(self, source, memoryMap=False):
+        self.sections = loadSections(source, memoryMap=memoryMap, lazy=True, validation="off")
+        self.sectionLoader = LazySectionLoader(self.sections, False)
+        self.sectionIndexAndRecordIndexToRecordMap = {}
+
+    def recordAt(self, sectionIndex, recordIndex):
+        key = (sectionIndex, recordIndex)
+        record = self.sectionIndexAndRecordIndexToRecordMap.get(key)
+        if record is None:
+            section = self.sections[sectionIndex]
+            structureDescription = section.structureDescription
+            record = structureDescription.createInstance(section.rawBytes, recordIndex * structureDescription.size, checkExpectedValue=False)
+            self.sectionIndexAndRecordIndexToRecordMap[key] = record
+        return record
+
+    def referencedContent(self, field, reference):
+        """ Returns the content of a reference field like loadModel would, but with a QueryList instead of a list of structures """
+        if reference.entries == 0:
+            if field.historyOfReferencedStructures is None:
+                return []
+            return field.historyOfReferencedStructures.createEmptyArray()
+        if reference.index >= len(self.sections):
+            raise Exception("Field %s references the section %d, but there are only %d sections" % (field.name, reference.index, len(self.sections)))
+        section = self.sections[reference.index]
+        if section.structureDescription.isPrimitive:
+            self.sectionLoader.determineContentOfSection(reference.index)
+            return section.content
+        return QueryList(self, reference.index, section.indexEntry.repetitions)
+
+    def fieldValue(self, value, fieldName, path):
+        if isinstance(value, (QueryList, list)):
+            raise Exception("%s is a list: Select elements with [*] or [index] before accessing the field %s" % (path, fieldName))
+        if not isinstance(value, M3Structure):
+            raise Exception("%s is not a structure, so it has no field %s" % (path, fieldName))
+        field = value.structureDescription.nameToFieldMap.get(fieldName)
+        if field is None:
+            raise Exception("%s of type %s has no field %s" % (path, value.structureDescription.structureName, fieldName))
+        fieldContent = getattr(value, fieldName)
+        if isinstance(field, ReferenceField):
+            return self.referencedContent(field, fieldContent)
+        return fieldContent
+
+    def selectElements(self, values, indexString, path):
+        selectedValues = []
+        for value in values:
+            if isinstance(value, QueryList):
+                if indexString == "*":
+                    selectedValues.extend(value.getAll())
+                else:
+                    selectedValues.append(value.get(int(indexString)))
+            elif isinstance(value, (list, str, bytes, bytearray)):
+                if indexString == "*":
+                    selectedValues.extend(value)
+                else:
+                    selectedValues.append(value[int(indexString)])
+            else:
+                raise Exception("%s is not a list and can't be indexed with [%s]" % (path, indexString))
+        return selectedValues
+
+    def resultValue(self, value):
+        if isinstance(value, QueryList):
+            return [self.resultValue(record) for record in value.getAll()]
+        if isinstance(value, M3Structure):
+            # The cached records must keep their plain references for later queries:
+            value = copy.deepcopy(value)
+            value.prepareLazyReferences(self.sectionLoader)
+        return value
+
+    def query(self, path):
+        """ Returns a list with all values which match the path """
+        pathParts = path.split(".")
+        rootMatch = queryPathPartPattern.match(pathParts[0])
+        if rootMatch is None:
+            raise Exception("Invalid query path %s" % path)
+        rootName = rootMatch.group(1)
+        if rootName == "model":
+            values = [self.fieldValue(self.recordAt(0, 0), "model", rootName).get(0)]
+        else:
+            values = []
+            for sectionIndex, section in enumerate(self.sections):
+                if section.indexEntry.tag == rootName:
+                    values.extend(QueryList(self, sectionIndex, section.indexEntry.repetitions).getAll())
+        for indexString in queryIndexPattern.findall(rootMatch.group(2)):
+            values = self.selectElements(values, indexString, rootName)
+
+        currentPath = rootName
+        for pathPart in pathParts[1:]:
+            match = queryPathPartPattern.match(pathPart)
+            if match is None:
+                raise Exception("Invalid part %s in query path %s" % (pathPart, path))
+            fieldName = match.group(1)
+            values = [self.fieldValue(value, fieldName, currentPath) for value in values]
+            currentPath += "." + fieldName
+            for indexString in queryIndexPattern.findall(match.group(2)):
+                values = self.selectElements(values, indexString, currentPath)
+                currentPath += "[%s]" % indexString
+        return [self.resultValue(value) for value in values]
+
+def query(filename, path, memoryMap=False):
+    """ Returns a list with the values in the m3 file which match the path, see ModelQuery """
+    return ModelQuery(filename, memoryMap).query(path)
+
+class HashedModel:
+    """ A lazily loaded model with a hash of the raw bytes of each section and a subtree hash of each section
+    together with all sections it references directly or indirectly. Equal subtree hashes mean equal decoded content,
+    so that comparisons can skip them without decoding the sections.
+
+    childrenCache maps section hashes to the indices of the referenced sections, which only depend on the bytes
+    of a section. Passing the childrenCache of a similar model avoids decoding the sections both have in common """
+
+    def __init__(self, source, childrenCache=None, memoryMap=False):
+        self.model = loadModel(source, checkExpectedValue=False, memoryMap=memoryMap, lazy=True, validation="off")
+        self.sectionLoader = self.model.lazySectionLoader
+        self.sections = self.sectionLoader.sections
+        self.sectionHashes = [self.hashOfSection(section) for section in self.sections]
+        self.subtreeHashes = [None] * len(self.sections)
+        self.previousChildrenCache = {} if childrenCache is None else childrenCache
+        self.childrenCache = {}
+        self.contentIdToSectionIndexMap = {}
+        # Determine all subtree hashes before comparisons resolve the lazy references:
+        for sectionIndex in range(len(self.sections)):
+            self.subtreeHash(sectionIndex)
+
+    @staticmethod
+    def hashOfSection(section):
+        indexEntry = section.indexEntry
+        hasher = hashlib.sha1(("%s %d %d " % (indexEntry.tag, indexEntry.version, indexEntry.repetitions)).encode("ascii"))
+        hasher.update(section.rawBytes)
+        return hasher.digest()
+
+    def childrenOfSection(self, sectionIndex):
+        sectionHash = self.sectionHashes[sectionIndex]
+        children = self.childrenCache.get(sectionHash)
+        if children is None:
+            children = self.previousChildrenCache.get(sectionHash)
+        if children is None:
+            children = []
+            section = self.sections[sectionIndex]
+            if section.structureDescription.containsReferences():
+                self.sectionLoader.determineContentOfSection(sectionIndex)
+                for instance in section.content:
+                    self.addReferencedSectionIndices(instance, children)
+            children = tuple(children)
+        self.childrenCache[sectionHash] = children
+        return children
+
+    def addReferencedSectionIndices(self, instance, children):
+        for field in instance.structureDescription.fields:
+            if isinstance(field, ReferenceField):
+                sectionIndex = self.referencedSectionIndex(instance, field)
+                if sectionIndex is not None:
+                    children.append(sectionIndex)
+            elif isinstance(field, EmbeddedStructureField):
+                self.addReferencedSectionIndices(getattr(instance, field.name), children)
+
+    def subtreeHash(self, sectionIndex):
+        subtreeHash = self.subtreeHashes[sectionIndex]
+        if subtreeHash is None:
+            children = self.childrenOfSection(sectionIndex)
+            if len(children) == 0:
+                subtreeHash = self.sectionHashes[sectionIndex]
+            else:
+                hasher = hashlib.sha1(self.sectionHashes[sectionIndex])
+                for childIndex in children:
+                    hasher.update(self.subtreeHash(childIndex))
+                subtreeHash = hasher.digest()
+            self.subtreeHashes[sectionIndex] = subtreeHash
+        return subtreeHash
+
+    def sectionIndexOfContent(self, content):
+        sectionIndex = self.contentIdToSectionIndexMap.get(id(content))
+        if sectionIndex is None:
+            for index, section in enumerate(self.sections):
+                if hasattr(section, "content"):
+                    self.contentIdToSectionIndexMap[id(section.content)] = index
+            sectionIndex = self.contentIdToSectionIndexMap.get(id(content))
+        return sectionIndex
+
+    def referencedSectionIndex(self, owner, field):
+        """ Returns the index of the section referenced by the field without resolving it or None for empty references """
+        lazyReferences = getattr(owner, "lazyReferences", None)
+        if lazyReferences is not None and field.name in lazyReferences:
+            reference = lazyReferences[field.name].reference
+            if reference.entries == 0 or reference.index >= len(self.sections):
+                return None
+            return reference.index
+        # The reference got already resolved:
+        content = getattr(owner, field.name)
+        if content is None or len(content) == 0:
+            return None
+        return self.sectionIndexOfContent(content)
+
+    def referencedSubtreeHash(self, owner, field):
+        sectionIndex = self.referencedSectionIndex(owner, field)
+        if sectionIndex is None:
+            return None
+        return self.subtreeHash(sectionIndex)
+
+    def recordBytes(self, sectionIndex, recordIndex):
+        size = self.sections[sectionIndex].structureDescription.size
+        return self.sections[sectionIndex].rawBytes[recordIndex * size:(recordIndex + 1) * size]
+
+    def modelSectionIndex(self):
+        header = self.sections[0].content[0]
+        return self.sectionIndexOfContent(header.model)
+
+
+class ModelDiffer:
+    """ Determines the differences between two models as a list of dictionaries with the keys path, kind, old and new.
+    The kind is "value" for changed values, "length" for lists with a different number of elements, "structure"
+    when the structure name or version changed and "bytes" for byte arrays like the vertices with changed bytes,
+    in which case old and new are the start and end offset of the changed range. References whose sections have equal subtree hashes get skipped,
+    and of records with equal bytes only the references get compared """
+
+    def __init__(self, previous, current):
+        self.previous = previous
+        self.current = current
+        self.differences = []
+
+    def addDifference(self, path, kind, old, new):
+        self.differences.append({"path": path, "kind": kind, "old": old, "new": new})
+
+    def diff(self):
+        previousIndex = self.previous.modelSectionIndex()
+        currentIndex = self.current.modelSectionIndex()
+        if not self.subtreesEqual(previousIndex, currentIndex):
+            self.diffStructures(self.previous.model, self.current.model, "model", self.recordsEqual(previousIndex, currentIndex, 0))
+        return self.differences
+
+    def subtreesEqual(self, previousIndex, currentIndex):
+        """ Returns True if the comparison of the referenced sections can be skipped. The indices can be None for empty references """
+        return previousIndex is not None and currentIndex is not None and self.previous.subtreeHash(previousIndex) == self.current.subtreeHash(currentIndex)
+
+    def recordsEqual(self, previousIndex, currentIndex, recordIndex):
+        """ Returns True if the values of the record can be skipped, so that only its references need to be compared """
+        return previousIndex is not None and currentIndex is not None and self.previous.recordBytes(previousIndex, recordIndex) == self.current.recordBytes(currentIndex, recordIndex)
+
+    def diffStructures(self, previous, current, path, recordBytesEqual=False):
+        previousType = previous.structureDescription
+        currentType = current.structureDescription
+        if previousType.structureName != currentType.structureName or previousType.structureVersion != currentType.structureVersion:
+            self.addDifference(path, "structure", "%sV%d" % (previousType.structureName, previousType.structureVersion), "%sV%d" % (currentType.structureName, currentType.structureVersion))
+            return
+        for field in previousType.fields:
+            fieldPath = path + "." + field.name
+            if isinstance(field, ReferenceField):
+                self.diffReferences(previous, current, field, fieldPath)
+            elif isinstance(field, EmbeddedStructureField):
+                if not recordBytesEqual or field.structureDescription.containsReferences():
+                    self.diffStructures(getattr(previous, field.name), getattr(current, field.name), fieldPath, recordBytesEqual)
+            elif not recordBytesEqual:
+                self.diffValues(getattr(previous, field.name), getattr(current, field.name), fieldPath)
+
+    def diffValues(self, old, new, path):
+        # NaN values differ from each other, but a NaN which stays a NaN is no change:
+        if old != new and (old == old or new == new):
+            self.addDifference(path, "value", old, new)
+
+    def diffReferences(self, previous, current, field, path):
+        previousIndex = self.previous.referencedSectionIndex(previous, field)
+        currentIndex = self.current.referencedSectionIndex(current, field)
+        if self.subtreesEqual(previousIndex, currentIndex):
+            return
+        old = getattr(previous, field.name)
+        new = getattr(current, field.name)
+        if isinstance(field, CharReferenceField):
+            self.diffValues(old, new, path)
+            return
+        if isinstance(field, ByteReferenceField):
+            self.diffBytes(old, new, path)
+            return
+        if len(old) != len(new):
+            self.addDifference(path, "length", len(old), len(new))
+        if isinstance(field, StructureReferenceField):
+            for index, (oldElement, newElement) in enumerate(zip(old, new)):
+                self.diffStructures(oldElement, newElement, "%s[%d]" % (path, index), self.recordsEqual(previousIndex, currentIndex, index))
+        else:
+            for index, (oldElement, newElement) in enumerate(zip(old, new)):
+                self.diffValues(oldElement, newElement, "%s[%d]" % (path, index))
+
+    def diffBytes(self, old, new, path, chunkSize=4096):
+        if len(old) != len(new):
+            self.addDifference(path, "length", len(old), len(new))
+            return
+        if old == new:
+            return
+        # Narrow down the changed range chunk wise, since the vertices can have millions of bytes:
+        start = 0
+        while old[start:start + chunkSize] == new[start:start + chunkSize]:
+            start += chunkSize
+        while old[start] == new[start]:
+            start += 1
+        end = len(old)
+        while old[max(end - chunkSize, start):end] == new[max(end - chunkSize, start):end]:
+            end = max(end - chunkSize, start)
+        while old[end - 1] == new[end - 1]:
+            end -= 1
+        self.addDifference(path, "bytes", start, end)
+
+def diffModels(previousSource, currentSource, memoryMap=False):
+    """ Returns the differences between two m3 files or buffers, see ModelDiffer """
+    previous = HashedModel(previousSource, memoryMap=memoryMap)
+    current = HashedModel(currentSource, previous.childrenCache, memoryMap)
+    return ModelDiffer(previous, current).diff()
+
 class IndexReferenceSourceAndSectionListMaker:
-    """ Creates a list of sections which are needed to store the objects for which index references are requested"""
-    def __init__(self):
+    """ Creates a list of sections which are needed to store the objects for which index references are requested.
+
+    With deduplicate=True sections with identical content get stored only once. This works only for sections
+    without references, like strings, key frames or vertices, since the bytes of other sections depend on the
+    indices of the sections they reference, which are not known yet. savedBytesPerTag records the saved bytes"""
+    def __init__(self, deduplicate=False):
         self.objectsIdToIndexReferenceMap = {}
         self.offset = 0
         self.nextFreeIndexPosition = 0
         self.sections = []
         self.MD34IndexEntry = structures["MD34IndexEntry"].getVersion(0)
+        self.deduplicate = deduplicate
+        self.contentHashToIndexReferenceMap = {}
+        self.savedBytesPerTag = {}
 
     def getIndexReferenceTo(self, objectsToSave, referenceStructureDescription, structureDescription):
         if id(objectsToSave) in self.objectsIdToIndexReferenceMap.keys():
@@ -1181,6 +2182,19 @@ class IndexReferenceSourceAndSectionListMaker:
         else:
             repetitions = structureDescription.countInstances(objectsToSave)
 
+        if self.deduplicate and repetitions > 0 and not structureDescription.containsReferences():
+            contentBytes = structureDescription.instancesToBytes(objectsToSave)
+            contentHash = (structureDescription.structureName, structureDescription.structureVersion, hashlib.sha256(contentBytes).digest())
+            indexReference = self.contentHashToIndexReferenceMap.get(contentHash)
+            if indexReference is not None and indexReference.structureDescription is referenceStructureDescription:
+                tag = structureDescription.structureName
+                savedBytes = increaseToValidSectionSize(len(contentBytes)) + self.MD34IndexEntry.size
+                self.savedBytesPerTag[tag] = self.savedBytesPerTag.get(tag, 0) + savedBytes
+                self.objectsIdToIndexReferenceMap[id(objectsToSave)] = indexReference
+                return indexReference
+        else:
+            contentHash = None
+
         indexReference = referenceStructureDescription.createInstance()
         indexReference.entries = repetitions
         indexReference.index = self.nextFreeIndexPosition
@@ -1198,6 +2212,8 @@ class IndexReferenceSourceAndSectionListMaker:
             section.structureDescription = structureDescription
             self.sections.append(section)
             self.objectsIdToIndexReferenceMap[id(objectsToSave)] = indexReference
+            if contentHash is not None:
+                self.contentHashToIndexReferenceMap[contentHash] = indexReference
             totalBytes = section.bytesRequiredForContent()
             totalBytes = increaseToValidSectionSize(totalBytes)
             self.offset += totalBytes
@@ -1205,53 +2221,135 @@ class IndexReferenceSourceAndSectionListMaker:
         return indexReference
 
 
-def modelToSections(model):
+def modelToSections(model, deduplicate=False, savedBytesPerTag=None):
+    """ Determines the sections and their offsets. The content of the sections gets encoded later by saveSections,
+    or by Section.determineFieldRawBytes when the raw bytes of a section are needed.
+    See IndexReferenceSourceAndSectionListMaker for deduplicate; the saved bytes get added to the savedBytesPerTag dictionary """
     MD34V11 = structures["MD34"].getVersion(11)
     header = MD34V11.createInstance()
     header.tag = "MD34"
     header.model = [model]
     ReferenceV0 = structures["Reference"].getVersion(0)
-    indexMaker = IndexReferenceSourceAndSectionListMaker()
+    indexMaker = IndexReferenceSourceAndSectionListMaker(deduplicate)
     indexMaker.getIndexReferenceTo([header], ReferenceV0, MD34V11)
     header.introduceIndexReferences(indexMaker)
     sections = indexMaker.sections
     header.indexOffset = indexMaker.offset
     header.indexSize = len(sections)
+    if savedBytesPerTag is not None:
+        for tag, savedBytes in indexMaker.savedBytesPerTag.items():
+            savedBytesPerTag[tag] = savedBytesPerTag.get(tag, 0) + savedBytes
 
-    for section in sections:
-        section.determineFieldRawBytes()
     return sections
 
-def saveSections(sections, filename):
+def sectionsFileSize(sections):
+    header = sections[0].content[0]
+    MD34IndexEntry = structures["MD34IndexEntry"].getVersion(0)
+    return header.indexOffset + MD34IndexEntry.size * len(sections)
+
+def writeSectionsToBuffer(sections, buffer):
+    """ Writes the sections and the index into a buffer of size sectionsFileSize(sections).
+    Sections which have no rawBytes get encoded directly into the buffer """
+    offset = 0
+    previousSection = None
+    for section in sections:
+        if section.indexEntry.offset != offset:
+            raise Exception("Section length problem: Section with index entry %(previousIndexEntry)s ends at %(offset)s and gets followed by section with index entry %(currentIndexEntry)s" % {"previousIndexEntry": previousSection.indexEntry, "offset": offset, "currentIndexEntry": section.indexEntry})
+        if hasattr(section, "rawBytes"):
+            end = offset + len(section.rawBytes)
+            buffer[offset:end] = section.rawBytes
+            offset = end
+        else:
+            offset = section.writeContentToBuffer(buffer, offset)
+        previousSection = section
+    header = sections[0].content[0]
+    if offset != header.indexOffset:
+        raise Exception("Not at expected write position %s after writing sections, but %s" % (header.indexOffset, offset))
+    MD34IndexEntry = structures["MD34IndexEntry"].getVersion(0)
+    offset = MD34IndexEntry.writeInstancesToBuffer([section.indexEntry for section in sections], buffer, offset)
+    if offset != len(buffer):
+        raise Exception("Expected that the index ends at %s, but it ended at %s" % (len(buffer), offset))
+
+def saveSections(sections, filename, memoryMap=False):
+    """ Lays out the whole file in a single buffer and writes it at once.
+    With memoryMap=True the buffer is a memory map of the output file instead """
+    fileSize = sectionsFileSize(sections)
     fileObject = open(filename, "w+b")
     try:
-        previousSection = None
-        for section in sections:
-            if section.indexEntry.offset != fileObject.tell():
-                raise Exception("Section length problem: Section with index entry %(previousIndexEntry)s has length %(previousLength)s and gets followed by section with index entry %(currentIndexEntry)s" % {"previousIndexEntry": previousSection.indexEntry, "previousLength": len(previousSection.rawBytes), "currentIndexEntry": section.indexEntry})
-            fileObject.write(section.rawBytes)
-            previousSection = section
-        header = sections[0].content[0]
-        if fileObject.tell() != header.indexOffset:
-            raise Exception("Not at expected write position %s after writing sections, but %s" % (header.indexOffset, fileObject.tell()))
-        for section in sections:
-            indexEntryBytesBuffer = bytearray(section.indexEntry.structureDescription.size)
-            section.indexEntry.writeToBuffer(indexEntryBytesBuffer, 0)
-            fileObject.write(indexEntryBytesBuffer)
+        if memoryMap:
+            fileObject.truncate(fileSize)
+            buffer = mmap.mmap(fileObject.fileno(), fileSize)
+            try:
+                writeSectionsToBuffer(sections, buffer)
+                buffer.flush()
+            finally:
+                buffer.close()
+        else:
+            buffer = bytearray(fileSize)
+            writeSectionsToBuffer(sections, buffer)
+            fileObject.write(buffer)
     finally:
         fileObject.close()
 
-def saveAndInvalidateModel(model, filename):
-    '''Do not use the model object after calling this method since it gets modified'''
-    model.structureDescription.validateInstance(model, "model")
-    sections = modelToSections(model)
-    saveSections(sections, filename)
+def saveAndInvalidateModel(model, filename, validation="full", memoryMap=False, deduplicate=False):
+    '''Do not use the model object after calling this method since it gets modified.
+    Returns a dictionary with the bytes saved per tag by deduplicate, see IndexReferenceSourceAndSectionListMaker'''
+    validateModel(model, validation)
+    savedBytesPerTag = {}
+    sections = modelToSections(model, deduplicate, savedBytesPerTag)
+    saveSections(sections, filename, memoryMap)
+    return savedBytesPerTag
+
+def saveChangedModel(model, filename, validation="full"):
+    """ Saves a model loaded with trackChanges=True by copying the original bytes of unchanged sections
+    and re-encoding only the modified ones. The model stays usable in that case and True gets returned.
+
+    If the model does no longer fit into the original section layout, e.g. because a list got longer
+    or a section is no longer referenced, it gets saved with saveAndInvalidateModel instead and False gets returned.
+
+    The unmodified sections got validated while loading, so only the modified structures get validated """
+    checkValidationLevel(validation)
+    modelSection = getattr(model, "loadedSection", None)
+    if modelSection is None:
+        raise Exception("Only models loaded with trackChanges=True can be saved with saveChangedModel")
+    sections = modelSection.loadedSections
+    referenceCounts = [section.timesReferenced for section in sections]
+    sectionRawBytes = []
+    for section in sections:
+        rawBytes = section.determineChangedRawBytes(sections, validation, referenceCounts)
+        if rawBytes is None:
+            saveAndInvalidateModel(model, filename, validation)
+            return False
+        sectionRawBytes.append(rawBytes)
+    # A changed reference can leave the section it pointed to unreferenced, which loadModel does not accept:
+    for section, referenceCount in zip(sections[1:], referenceCounts[1:]):
+        if referenceCount == 0 and section.timesReferenced != 0:
+            saveAndInvalidateModel(model, filename, validation)
+            return False
+
+    header = sections[0].content[0]
+    MD34IndexEntry = structures["MD34IndexEntry"].getVersion(0)
+    buffer = bytearray(header.indexOffset + MD34IndexEntry.size * len(sections))
+    for section, rawBytes in zip(sections, sectionRawBytes):
+        offset = section.indexEntry.offset
+        buffer[offset:offset + len(rawBytes)] = rawBytes
+    MD34IndexEntry.writeInstancesToBuffer([section.indexEntry for section in sections], buffer, header.indexOffset)
+    with open(filename, "wb") as fileObject:
+        fileObject.write(buffer)
+    return True
+
+def verifySchema():
+    """ Creates the descriptions of all known versions of all structures, which checks their sizes, and compiles their record codecs """
+    for structureHistory in structures.values():
+        for version in structureHistory.versionToSizeMap:
+            structureHistory.getVersion(version).compileRecordCodec()
 
 def readStructures():
     from os import path
     directory = path.dirname(__file__)
     structuresXmlPath = path.join(directory, "structures.xml")
-    return readStructureDefinitions(structuresXmlPath)
+    schemaCachePath = path.join(directory, "structures.cache")
+    return readStructureDefinitionsWithCache(structuresXmlPath, schemaCachePath, [__file__])
 
 
 structures = readStructures()
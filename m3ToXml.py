@@ -21,17 +21,26 @@
 
 import sys
 import m3
+import batchTools
 import argparse
 import os.path
 import os
-import io
 import time
-import traceback
 import re
+import base64
 from xml.sax.saxutils import escape
 
+hexChunkSize = 1 << 16
+primitiveListChunkSize = 4096
+
 def byteDataToHex(byteData):
-    return '0x' + ''.join(["%02x" % x for x in byteData])
+    return '0x' + bytes(byteData).hex()
+
+def writeByteDataAsHex(out, byteData):
+    out.write('0x')
+    byteData = memoryview(byteData)
+    for chunkStart in range(0, len(byteData), hexChunkSize):
+        out.write(byteData[chunkStart:chunkStart + hexChunkSize].hex())
 
 
 def indent(level):
@@ -47,134 +56,174 @@ def openCloseTag(name):
     return "<%s />\n" % name
 
 
+def primitiveToText(value):
+    if type(value) is int:
+        return hex(value)
+    return str(value)
+
 def printXmlElement(out, level, name, value):
     out.write(indent(level) + openTag(name) + value + closeTag(name))
 
+def printPrimitiveList(out, level, name, value):
+    elementFormat = "%s<%s>%%s</%s>\n" % (indent(level), name, name)
+    for chunkStart in range(0, len(value), primitiveListChunkSize):
+        chunk = value[chunkStart:chunkStart + primitiveListChunkSize]
+        out.write("".join([elementFormat % primitiveToText(entry) for entry in chunk]))
+
 def printObject(out, level, name, value):
-    valueType = type(value)
-    if value is None:
-        out.write(indent(level) + openCloseTag(name))
-        return
-
-    elif valueType == int:
-        value = hex(value)
-        printXmlElement(out, level, name, value)
-        return
-
-    elif valueType == bytearray or valueType == bytes:
-        value = byteDataToHex(value)
-        printXmlElement(out, level, name, value)
-        return
-
-    elif valueType == str:
-        # get rid of non ASCII characters
-        value = re.sub('[^\x20-\x7F]', '.', str(value))
-        # escape special XML characters (such as "&" -> "&amp;")
-        value = escape(value)
-        printXmlElement(out, level, name, value)
-        return
-
-    elif valueType == list:
-        if len(value) == 0:
-            out.write(indent(level) + openTag(name) + closeTag(name))
-            return
-        firstObject = value[0]
-        if isinstance(firstObject, m3.M3Structure):
-            structureName = firstObject.structureDescription.structureName
-            structureVersion = firstObject.structureDescription.structureVersion
-            out.write(('%s<%s structureName="%s" structureVersion="%s" >\n' % (indent(level), name, structureName, structureVersion)))
-        else:
+    """ Writes the value as XML element. Uses an explicit stack instead of recursion:
+    An entry of the stack is either a text to write or a tuple (level, name, value) of an element to write """
+    stack = [(level, name, value)]
+    while stack:
+        entry = stack.pop()
+        if isinstance(entry, str):
+            out.write(entry)
+            continue
+        level, name, value = entry
+        valueType = type(value)
+        if value is None:
+            out.write(indent(level) + openCloseTag(name))
+
+        elif valueType == int:
+            printXmlElement(out, level, name, hex(value))
+
+        elif valueType == bytearray or valueType == bytes:
+            out.write(indent(level) + openTag(name))
+            writeByteDataAsHex(out, value)
+            out.write(closeTag(name))
+
+        elif valueType == str:
+            # get rid of non ASCII characters
+            value = re.sub('[^\x20-\x7F]', '.', str(value))
+            # escape special XML characters (such as "&" -> "&amp;")
+            value = escape(value)
+            printXmlElement(out, level, name, value)
+
+        elif valueType == list:
+            if len(value) == 0:
+                out.write(indent(level) + openTag(name) + closeTag(name))
+                continue
+            firstObject = value[0]
+            if isinstance(firstObject, m3.M3Structure):
+                structureName = firstObject.structureDescription.structureName
+                structureVersion = firstObject.structureDescription.structureVersion
+                out.write(('%s<%s structureName="%s" structureVersion="%s" >\n' % (indent(level), name, structureName, structureVersion)))
+                stack.append(indent(level) + closeTag(name))
+                elementName = name + "-element"
+                for listEntry in reversed(value):
+                    stack.append((level + 1, elementName, listEntry))
+            else:
+                out.write(indent(level) + openTag(name) + "\n")
+                printPrimitiveList(out, level + 1, name + "-element", value)
+                out.write(indent(level) + closeTag(name))
+
+        elif isinstance(value, m3.M3Structure):
             out.write(indent(level) + openTag(name) + "\n")
-        for entry in value:
-            printObject(out, level + 1, name + "-element", entry)
-
-        out.write(indent(level) + closeTag(name))
-        return
-
-    elif valueType == m3.M3Structure:
-        out.write(indent(level) + openTag(name) + "\n")
-
-        for field in value.structureDescription.fields:
-            v = getattr(value, field.name)
-            printObject(out, level + 1, field.name, v)
+            stack.append(indent(level) + closeTag(name))
+            for field in reversed(value.structureDescription.fields):
+                stack.append((level + 1, field.name, getattr(value, field.name)))
 
+        else:
+            printXmlElement(out, level, name, str(value))
+
+
+vertexEncodings = ("hex", "columns", "base64")
+base64ChunkSize = 57 * 1024 # multiple of 3 so that only the last chunk can have padding
+
+def printVerticesAsBase64(out, level, name, vertices):
+    out.write('%s<%s encoding="base64">\n' % (indent(level), name))
+    vertices = memoryview(vertices)
+    for chunkStart in range(0, len(vertices), base64ChunkSize):
+        out.write(base64.b64encode(vertices[chunkStart:chunkStart + base64ChunkSize]).decode("ascii"))
+        out.write("\n")
+    out.write(indent(level) + closeTag(name))
+
+def vertexColumnsOf(model):
+    """ Returns the description of the vertex format and the vertices as columns,
+    or None, None if the vertices can't be stored losslessly as columns """
+    vertexStructureHistory = m3.structures.get("VertexFormat" + hex(model.vFlags))
+    if vertexStructureHistory is None:
+        return None, None
+    vertexDescription = vertexStructureHistory.getVersion(0)
+    if len(model.vertices) % vertexDescription.size != 0:
+        return None, None
+    columns = vertexDescription.bytesToRawColumns(model.vertices)
+    # Floats get written with repr, which is exact except for NaNs: Their sign and payload get lost
+    for (columnName, formatChar), column in zip(vertexDescription.rawColumnFormats(), columns):
+        if formatChar in ("f", "d") and any(value != value for value in column):
+            return None, None
+    return vertexDescription, columns
+
+def printVertices(out, level, name, model, vertexEncoding):
+    """ Writes the vertices either like other byte data as hex string, as base64 text
+    or as one element per value of the vertex format with the values of all vertices """
+    if vertexEncoding == "hex":
+        printObject(out, level, name, model.vertices)
+    elif vertexEncoding == "base64":
+        printVerticesAsBase64(out, level, name, model.vertices)
+    elif vertexEncoding == "columns":
+        vertexDescription, columns = vertexColumnsOf(model)
+        if vertexDescription is None:
+            printVerticesAsBase64(out, level, name, model.vertices)
+            return
+        out.write('%s<%s encoding="columns" structureName="%s" structureVersion="%s" >\n' % (indent(level), name, vertexDescription.structureName, vertexDescription.structureVersion))
+        for (columnName, formatChar), column in zip(vertexDescription.rawColumnFormats(), columns):
+            out.write('%s<column name="%s" format="%s">' % (indent(level + 1), columnName, formatChar))
+            for chunkStart in range(0, len(column), primitiveListChunkSize):
+                if chunkStart > 0:
+                    out.write(" ")
+                out.write(" ".join(map(repr, column[chunkStart:chunkStart + primitiveListChunkSize])))
+            out.write(closeTag("column"))
         out.write(indent(level) + closeTag(name))
-        return
-
     else:
-        printXmlElement(out, level, name, str(value))
-        return
+        raise Exception("Unknown vertex encoding %s" % vertexEncoding)
 
-def printModel(model, outputFilePath):
-    outputStream = io.StringIO()
-
-    outputFile = open(outputFilePath, "w")
+def writeModel(model, out, vertexEncoding="hex"):
     modelDescription = model.structureDescription
-    outputStream.write('<model structureName="%s" structureVersion="%s" >\n' % (modelDescription.structureName, modelDescription.structureVersion))
+    out.write('<model structureName="%s" structureVersion="%s" >\n' % (modelDescription.structureName, modelDescription.structureVersion))
 
     for field in modelDescription.fields:
+        if field.name == "vertices":
+            printVertices(out, 0, field.name, model, vertexEncoding)
+            continue
         value = getattr(model, field.name)
-        printObject(outputStream, 0, field.name, value)
-
-    outputStream.write(closeTag("model"))
-
-    outputFile.write(outputStream.getvalue())
-    outputFile.close()
-
-    outputStream.close()
-
-
-def convertFile(inputFilePath, outputFilePath, continueAtErrors):
-    model = None
-    try:
-        model = m3.loadModel(inputFilePath)
-    except Exception as e:
-        if continueAtErrors:
-            sys.stderr.write("\nError: %s\n" % e)
-            sys.stderr.write("\nFile: %s\n" % inputFilePath)
-            sys.stderr.write("Trace: %s\n" % traceback.format_exc())
-        else:
-            raise e
-        return False
+        printObject(out, 0, field.name, value)
+
+    out.write(closeTag("model"))
+
+def printModel(model, outputFilePath, vertexEncoding="hex"):
+    """ Streams the model as XML to the file; "-" writes it to stdout """
+    if outputFilePath == "-":
+        try:
+            writeModel(model, sys.stdout, vertexEncoding)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # The reader like head closed the pipe, so stop quietly like other unix filters.
+            # stdout gets redirected to devnull, since Python would fail to flush it again at exit:
+            devNull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devNull, sys.stdout.fileno())
+            sys.exit(1)
+    else:
+        with open(outputFilePath, "w", buffering=1 << 20) as outputFile:
+            writeModel(model, outputFile, vertexEncoding)
 
-    printModel(model, outputFilePath)
-    return True
 
-def processFile(inputPath, outputDirectory, inputFilePath, continueAtErrors):
-    relativeInputPath = os.path.relpath(inputFilePath, inputPath)
-    relativeOutputPath = relativeInputPath + ".xml"
+def convertModel(inputFilePath, outputFilePath, validation="full", vertexEncoding="hex"):
+    outputDirectory = os.path.dirname(outputFilePath)
+    if outputDirectory and not os.path.exists(outputDirectory):
+        os.makedirs(outputDirectory, exist_ok=True)
+    model = m3.loadModel(inputFilePath, validation=validation)
+    printModel(model, outputFilePath, vertexEncoding)
 
+def outputFilePathFor(inputPath, outputDirectory, inputFilePath):
     if outputDirectory:
-        if outputDirectory and not os.path.exists(outputDirectory):
-            os.makedirs(outputDirectory)
-        outputFilePath = os.path.join(outputDirectory, relativeOutputPath)
+        relativeInputPath = os.path.relpath(inputFilePath, inputPath)
+        return os.path.join(outputDirectory, relativeInputPath + ".xml")
     else:
-        outputFilePath = inputFilePath + ".xml"
-
-    print("%s -> %s" % (inputFilePath, outputFilePath))
-
-    return convertFile(inputFilePath, outputFilePath, continueAtErrors)
-
-def processDirectory(inputPath, outputPath, recurse, continueAtErrors):
-
-    count, succeeded, failed = 0, 0, 0
-
-    for path, dirs, files in os.walk(inputPath):
+        return inputFilePath + ".xml"
 
-        for file in files:
-            if file.endswith(".m3"):
-
-                inputFilePath = os.path.join(path, file)
-                success = processFile(inputPath, outputPath, inputFilePath, continueAtErrors)
-
-                succeeded += success
-                failed += not success
-                count += 1
-
-        if not recurse:
-            break
-
-    return count, succeeded, failed
+def filePathPairsInDirectory(inputPath, outputPath, recurse):
+    return [(inputFilePath, outputFilePathFor(inputPath, outputPath, inputFilePath)) for inputFilePath in batchTools.m3FilesIn(inputPath, recurse)]
 
 
 if __name__ == "__main__":
@@ -182,17 +231,36 @@ if __name__ == "__main__":
     parser.add_argument('path', nargs='+', help="Either a *.m3 file or a directory with *.m3 files")
     parser.add_argument('--output-directory',
         '-o',
-        help='Directory in which m3 files will be placed')
+        help='Directory in which m3 files will be placed; with - the xml of a single m3 file gets written to stdout')
     parser.add_argument('-r', '--recurse',
         action='store_true', default=False,
         help='Recurse input directory and convert all m3 files found.')
     parser.add_argument('-c', '--continue-at-errors',
         action='store_true', default=False,
         help='Continue if there are errors in the files')
+    parser.add_argument('--validation',
+        choices=m3.validationLevels, default="full",
+        help='How thoroughly the m3 files get validated while loading them')
+    parser.add_argument('--vertex-encoding',
+        choices=vertexEncodings, default="hex",
+        help='Write the vertices as hex string, as base64 text or as one element per vertex value (columns)')
+    parser.add_argument('-j', '--jobs',
+        type=int, default=1,
+        help='Number of processes which convert files in parallel')
+    parser.add_argument('--summary',
+        help='Write the conversion time and result of each file as JSON to this file, or to stdout with -')
     args = parser.parse_args()
 
     outputDirectory = args.output_directory
-    if outputDirectory is not None and not os.path.isdir(outputDirectory):
+    toStdout = outputDirectory == "-"
+    if toStdout:
+        if len(args.path) != 1 or not os.path.isfile(args.path[0]):
+            sys.stderr.write("Writing to stdout is only supported for a single file\n")
+            sys.exit(2)
+        if args.summary == "-":
+            sys.stderr.write("The summary can't be written to stdout together with the xml\n")
+            sys.exit(2)
+    elif outputDirectory is not None and not os.path.isdir(outputDirectory):
         sys.stderr.write("%s is not a directory" % outputDirectory)
         sys.exit(2)
 
@@ -205,22 +273,30 @@ if __name__ == "__main__":
 
     continueAtErrors = args.continue_at_errors
 
+    # Keep stdout free for the xml or the JSON summary if they get written there
+    progressFile = sys.stderr if toStdout or args.summary == "-" else sys.stdout
+
     t0 = time.time()
-    print("Converting files.. %d" % len(args.path))
+    progressFile.write("Converting files.. %d\n" % len(args.path))
+    filePathPairs = []
     for path in args.path:
-        total, succeeded, failed = (0, 0, 0)
-        if os.path.isfile(path):
-            inputFilePath = path
-            path = os.path.dirname(path)
-            success = processFile(path, outputDirectory, inputFilePath, continueAtErrors)
-            totalDelta, succeededDelta, failedDelta = 1, success, not success
+        if toStdout:
+            filePathPairs.append((path, "-"))
+        elif os.path.isfile(path):
+            filePathPairs.append((path, outputFilePathFor(os.path.dirname(path), outputDirectory, path)))
         else:
-            totalDelta, succeededDelta, failedDelta = processDirectory(path, outputDirectory, recurse, continueAtErrors)
-        total += totalDelta
-        succeeded += succeededDelta
-        failed += failedDelta
+            filePathPairs.extend(filePathPairsInDirectory(path, outputDirectory, recurse))
+
+    # A worker process can't end the program quietly when stdout gets closed:
+    jobs = 1 if toStdout else args.jobs
+    results = batchTools.runFileConversions(convertModel, filePathPairs, jobs, continueAtErrors, (args.validation, args.vertex_encoding), progressFile)
+    total = len(filePathPairs)
+    succeeded = sum(1 for result in results if result["success"])
+    failed = len(results) - succeeded
 
     t1 = time.time()
-    print("%d files found, %d converted, %d failed in %.2f s" % (total, succeeded, failed, (t1 - t0)))
+    if args.summary is not None:
+        batchTools.writeConversionSummary(results, args.summary, t1 - t0)
+    progressFile.write("%d files found, %d converted, %d failed in %.2f s\n" % (total, succeeded, failed, (t1 - t0)))
     if failed > 0:
         sys.exit(1)
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import sys
+import m3
+import batchTools
+import argparse
+import os
+import json
+import time
+
+
+def diffFiles(previousFilePath, currentFilePath, relativePath):
+    """ Gets executed by the worker processes; returns a result dictionary with the differences or an error """
+    result = {"file": relativePath, "previous": previousFilePath, "current": currentFilePath}
+    try:
+        result["differences"] = m3.diffModels(previousFilePath, currentFilePath)
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+def relativeM3FilesIn(directory):
+    """ Returns the paths of the m3 files in the directory and its subdirectories relative to the directory """
+    return [os.path.relpath(filePath, directory) for filePath in batchTools.m3FilesIn(directory)]
+
+def jsonValue(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+def printResult(result):
+    if "error" in result:
+        print("Error in %s: %s" % (result["file"], result["error"]))
+        return
+    for difference in result["differences"]:
+        if difference["kind"] == "value":
+            print("%s: %s changed from %r to %r" % (result["file"], difference["path"], difference["old"], difference["new"]))
+        elif difference["kind"] == "length":
+            print("%s: The length of %s changed from %d to %d" % (result["file"], difference["path"], difference["old"], difference["new"]))
+        elif difference["kind"] == "bytes":
+            print("%s: The bytes of %s changed between offset %d and %d" % (result["file"], difference["path"], difference["old"], difference["new"]))
+        else:
+            print("%s: %s changed its structure from %s to %s" % (result["file"], difference["path"], difference["old"], difference["new"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the differences between two m3 files or between the m3 files of two directories.')
+    parser.add_argument('previous', help="The previous m3 file or directory")
+    parser.add_argument('current', help="The current m3 file or directory")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes which compare files in parallel')
+    parser.add_argument('--json', help='Write the differences as JSON to this file, or to stdout with -')
+    args = parser.parse_args()
+
+    startTime = time.time()
+    if os.path.isdir(args.previous) and os.path.isdir(args.current):
+        previousFiles = relativeM3FilesIn(args.previous)
+        currentFiles = relativeM3FilesIn(args.current)
+        currentFileSet = set(currentFiles)
+        previousFileSet = set(previousFiles)
+        removedFiles = [relativePath for relativePath in previousFiles if relativePath not in currentFileSet]
+        addedFiles = [relativePath for relativePath in currentFiles if relativePath not in previousFileSet]
+        filePairs = [(os.path.join(args.previous, relativePath), os.path.join(args.current, relativePath), relativePath) for relativePath in previousFiles if relativePath in currentFileSet]
+    elif os.path.isfile(args.previous) and os.path.isfile(args.current):
+        removedFiles = []
+        addedFiles = []
+        filePairs = [(args.previous, args.current, os.path.basename(args.current))]
+    else:
+        sys.stderr.write("Expected either two m3 files or two directories\n")
+        sys.exit(2)
+
+    if args.jobs > 1 and len(filePairs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(diffFiles, *zip(*filePairs)))
+    else:
+        results = [diffFiles(*filePair) for filePair in filePairs]
+
+    failed = sum(1 for result in results if "error" in result)
+    changed = sum(1 for result in results if len(result.get("differences", ())) > 0)
+    if args.json is not None:
+        summary = {"files": results, "removedFiles": removedFiles, "addedFiles": addedFiles, "changed": changed, "failed": failed, "seconds": time.time() - startTime}
+        if args.json == "-":
+            json.dump(summary, sys.stdout, indent=2, default=jsonValue)
+            sys.stdout.write("\n")
+        else:
+            with open(args.json, "w") as jsonFile:
+                json.dump(summary, jsonFile, indent=2, default=jsonValue)
+    if args.json != "-":
+        for relativePath in removedFiles:
+            print("Only in %s: %s" % (args.previous, relativePath))
+        for relativePath in addedFiles:
+            print("Only in %s: %s" % (args.current, relativePath))
+        for result in results:
+            printResult(result)
+    if failed > 0:
+        sys.exit(2)
+    if changed > 0 or len(removedFiles) > 0 or len(addedFiles) > 0:
+        sys.exit(1)
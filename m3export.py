@@ -1511,7 +1511,7 @@ class Exporter:
                 boneIndex = self.boneNameToBoneIndexMap.get(boneName)
                 if boneIndex is None:
                     boneIndex = self.addBoneWithRestPosAndReturnIndex(model, boneName, realBone=False)
-                m3Copy.bone = boneIndex
+                m3Copy.boneIndex = boneIndex
                 copyAnimPathPrefix = animPathPrefix + "copies[%d]." % blenderCopyIndex
                 transferer = BlenderToM3DataTransferer(exporter=self, m3Object=m3Copy, blenderObject=copy, animPathPrefix=copyAnimPathPrefix, rootObject=self.scene)
                 shared.transferParticleSystemCopy(transferer)
@@ -1605,7 +1605,7 @@ class Exporter:
             if boneIndex is None:
                 boneIndex = self.addBoneWithRestPosAndReturnIndex(model, boneName, realBone=False)
             m3Warp = self.createInstanceOf("WRP_")
-            m3Warp.bone = boneIndex
+            m3Warp.boneIndex = boneIndex
             animPathPrefix = "m3_warps[%s]." % warpIndex
             transferer = BlenderToM3DataTransferer(exporter=self, m3Object=m3Warp, blenderObject=warp, animPathPrefix=animPathPrefix, rootObject=self.scene)
             shared.transferWarp(transferer)
@@ -1933,13 +1933,10 @@ class Exporter:
         isVideo = shared.isVideoFilePath(layer.imagePath)
         m3Layer.setNamedBit("flags", "isVideo", isVideo)
         if not isVideo:
-            m3Layer.vidoeFrameRate = 0
+            m3Layer.videoFrameRate = 0
             m3Layer.videoStartFrame = 0
             m3Layer.videoEndFrame = 0
             m3Layer.videoMode = 0
-        m3Layer.unknownbc0c14e5 = self.createNullUInt32AnimationReference(0)
-        m3Layer.unknowne740df12 = self.createNullFloatAnimationReference(0.0, interpolationType=1)
-        m3Layer.unknown39ade219 = self.createNullUInt16AnimationReference(0)
         m3Layer.unknowna4ec0796 = self.createNullUInt32AnimationReference(0, interpolationType=1)
         m3Layer.unknowna44bf452 = self.createNullFloatAnimationReference(1.0, interpolationType=1)
         return m3Layer
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import sys
+import m3
+import batchTools
+import argparse
+import os
+import sqlite3
+import time
+
+catalogSchema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    modelVersion INTEGER,
+    vertexFlags INTEGER,
+    boneCount INTEGER,
+    materialCount INTEGER,
+    sequenceCount INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS structures (fileId INTEGER NOT NULL, tag TEXT NOT NULL, version INTEGER NOT NULL, sections INTEGER, repetitions INTEGER, bytes INTEGER);
+CREATE TABLE IF NOT EXISTS sequences (fileId INTEGER NOT NULL, name TEXT, animStartInMS INTEGER, animEndInMS INTEGER);
+CREATE TABLE IF NOT EXISTS bones (fileId INTEGER NOT NULL, name TEXT);
+CREATE TABLE IF NOT EXISTS textures (fileId INTEGER NOT NULL, path TEXT);
+CREATE INDEX IF NOT EXISTS structuresByTag ON structures (tag, version);
+CREATE INDEX IF NOT EXISTS structuresByFile ON structures (fileId);
+CREATE INDEX IF NOT EXISTS sequencesByName ON sequences (name);
+CREATE INDEX IF NOT EXISTS sequencesByFile ON sequences (fileId);
+CREATE INDEX IF NOT EXISTS bonesByName ON bones (name);
+CREATE INDEX IF NOT EXISTS bonesByFile ON bones (fileId);
+CREATE INDEX IF NOT EXISTS texturesByPath ON textures (path);
+CREATE INDEX IF NOT EXISTS texturesByFile ON textures (fileId);
+"""
+fileDataTables = ("structures", "sequences", "bones", "textures")
+
+
+def openCatalog(catalogPath):
+    connection = sqlite3.connect(catalogPath)
+    connection.executescript(catalogSchema)
+    return connection
+
+def catalogEntryOf(filePath, mtime, size):
+    """ Gets executed by the worker processes: Collects the metadata of a m3 file for the catalog.
+    The structures get taken from the index, so that they get recorded even if the model can't be loaded """
+    entry = {"path": filePath, "mtime": mtime, "size": size, "error": None, "structures": [], "sequences": [], "bones": [], "textures": []}
+    try:
+        scan = m3.scanIndex(filePath)
+        for tag, tagSummary in scan["tags"].items():
+            for version, versionSummary in tagSummary["versions"].items():
+                entry["structures"].append((tag, version, versionSummary["sections"], versionSummary["repetitions"], versionSummary["bytes"]))
+
+        modelQuery = m3.ModelQuery(filePath)
+        model = modelQuery.query("model")[0]
+        modelDescription = model.structureDescription
+        entry["modelVersion"] = modelDescription.structureVersion
+        if modelDescription.hasField("vFlags"):
+            entry["vertexFlags"] = model.vFlags
+        entry["sequences"] = [(sequence.name, sequence.animStartInMS, sequence.animEndInMS) for sequence in model.sequences]
+        entry["bones"] = [(bone.name,) for bone in model.bones]
+        entry["materialCount"] = len(model.materialReferences)
+        entry["textures"] = [(imagePath,) for imagePath in modelQuery.query("LAYR.imagePath") if imagePath]
+    except Exception as e:
+        entry["error"] = str(e)
+    return entry
+
+def storeCatalogEntry(connection, entry):
+    row = connection.execute("SELECT id FROM files WHERE path = ?", (entry["path"],)).fetchone()
+    if row is not None:
+        removeFileData(connection, row[0])
+    cursor = connection.execute("INSERT INTO files (path, mtime, size, modelVersion, vertexFlags, boneCount, materialCount, sequenceCount, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (entry["path"], entry["mtime"], entry["size"], entry.get("modelVersion"), entry.get("vertexFlags"), len(entry["bones"]), entry.get("materialCount"), len(entry["sequences"]), entry["error"]))
+    fileId = cursor.lastrowid
+    connection.executemany("INSERT INTO structures VALUES (?, ?, ?, ?, ?, ?)", [(fileId,) + structure for structure in entry["structures"]])
+    connection.executemany("INSERT INTO sequences VALUES (?, ?, ?, ?)", [(fileId,) + sequence for sequence in entry["sequences"]])
+    connection.executemany("INSERT INTO bones VALUES (?, ?)", [(fileId,) + bone for bone in entry["bones"]])
+    connection.executemany("INSERT INTO textures VALUES (?, ?)", [(fileId,) + texture for texture in entry["textures"]])
+
+def removeFileData(connection, fileId):
+    for table in fileDataTables:
+        connection.execute("DELETE FROM %s WHERE fileId = ?" % table, (fileId,))
+    connection.execute("DELETE FROM files WHERE id = ?", (fileId,))
+
+def refreshCatalog(connection, paths, recurse=True, jobs=1):
+    """ Updates the catalog entries of the m3 files in the given paths whose modification time or size changed
+    and removes the entries of deleted files within these paths. Returns the numbers of updated and removed files """
+    knownFiles = {}
+    for fileId, path, mtime, size in connection.execute("SELECT id, path, mtime, size FROM files"):
+        knownFiles[path] = (fileId, mtime, size)
+
+    filePaths = []
+    for path in paths:
+        filePaths.extend(os.path.abspath(filePath) for filePath in batchTools.m3FilesIn(path, recurse))
+    changedFiles = []
+    for filePath in filePaths:
+        fileStat = os.stat(filePath)
+        knownFile = knownFiles.get(filePath)
+        if knownFile is None or knownFile[1] != fileStat.st_mtime or knownFile[2] != fileStat.st_size:
+            changedFiles.append((filePath, fileStat.st_mtime, fileStat.st_size))
+
+    existingFiles = set(filePaths)
+    rootPaths = [os.path.abspath(path) for path in paths]
+    removedFileIds = []
+    for knownPath, (fileId, mtime, size) in knownFiles.items():
+        if knownPath in existingFiles:
+            continue
+        for rootPath in rootPaths:
+            if knownPath == rootPath or knownPath.startswith(os.path.join(rootPath, "")):
+                removedFileIds.append(fileId)
+                break
+
+    with connection:
+        for fileId in removedFileIds:
+            removeFileData(connection, fileId)
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        entries = executor.map(catalogEntryOf, *zip(*changedFiles), chunksize=16) if changedFiles else []
+    else:
+        executor = None
+        entries = (catalogEntryOf(filePath, mtime, size) for filePath, mtime, size in changedFiles)
+    try:
+        with connection:
+            for entry in entries:
+                if entry["error"] is not None:
+                    sys.stderr.write("Error in %s: %s\n" % (entry["path"], entry["error"]))
+                storeCatalogEntry(connection, entry)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return len(changedFiles), len(removedFileIds)
+
+def findFiles(connection, texture=None, bone=None, sequence=None, structure=None):
+    """ Returns the paths of the cataloged files which match all given criteria.
+    texture is a part of a texture path and structure is either a tag or tag:version """
+    conditions = []
+    parameters = []
+    if texture is not None:
+        conditions.append("id IN (SELECT fileId FROM textures WHERE path LIKE ?)")
+        parameters.append("%" + texture + "%")
+    if bone is not None:
+        conditions.append("id IN (SELECT fileId FROM bones WHERE name = ?)")
+        parameters.append(bone)
+    if sequence is not None:
+        conditions.append("id IN (SELECT fileId FROM sequences WHERE name = ?)")
+        parameters.append(sequence)
+    if structure is not None:
+        if ":" in structure:
+            tag, version = structure.split(":", 1)
+            conditions.append("id IN (SELECT fileId FROM structures WHERE tag = ? AND version = ?)")
+            parameters.extend([tag, int(version)])
+        else:
+            conditions.append("id IN (SELECT fileId FROM structures WHERE tag = ?)")
+            parameters.append(structure)
+    statement = "SELECT path FROM files"
+    if len(conditions) > 0:
+        statement += " WHERE " + " AND ".join(conditions)
+    statement += " ORDER BY path"
+    return [row[0] for row in connection.execute(statement, parameters)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Maintain a SQLite catalog with metadata of m3 files.')
+    parser.add_argument('catalog', help="The SQLite file of the catalog; gets created if it doesn't exist")
+    subparsers = parser.add_subparsers(dest='command')
+    refreshParser = subparsers.add_parser('refresh', help='Add or update the m3 files which changed since the last refresh')
+    refreshParser.add_argument('path', nargs='+', help="Either a *.m3 file or a directory with *.m3 files")
+    refreshParser.add_argument('--no-recurse', action='store_true', default=False, help='Do not scan the subdirectories of directories')
+    refreshParser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes which read files in parallel')
+    findParser = subparsers.add_parser('find', help='List the cataloged files which match all given criteria')
+    findParser.add_argument('--texture', help='Part of the path of a texture used by a layer')
+    findParser.add_argument('--bone', help='Name of a bone')
+    findParser.add_argument('--sequence', help='Name of an animation sequence')
+    findParser.add_argument('--structure', help='Structure tag, optionally with version like LAYR:22')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        sys.exit(2)
+
+    connection = openCatalog(args.catalog)
+    try:
+        if args.command == "refresh":
+            for path in args.path:
+                if not os.path.isdir(path) and not os.path.isfile(path):
+                    sys.stderr.write("Path %s is not a valid directory or file\n" % path)
+                    sys.exit(2)
+            startTime = time.time()
+            updated, removed = refreshCatalog(connection, args.path, not args.no_recurse, args.jobs)
+            print("%d files updated, %d removed in %.2f s" % (updated, removed, time.time() - startTime))
+        elif args.command == "find":
+            for path in findFiles(connection, args.texture, args.bone, args.sequence, args.structure):
+                print(path)
+    finally:
+        connection.close()
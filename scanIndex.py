@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import sys
+import m3
+import batchTools
+import argparse
+import os
+import json
+import time
+
+
+def scanFile(filePath):
+    """ Gets executed by the worker processes; returns the scan result or an error dictionary """
+    try:
+        return m3.scanIndex(filePath)
+    except Exception as e:
+        return {"file": filePath, "error": str(e)}
+
+def addScanToTotals(scan, totals):
+    """ Adds the per tag and per version numbers of a scan to the totals, counting also the files with the tag or version """
+    for tag, tagSummary in scan["tags"].items():
+        tagTotal = totals.get(tag)
+        if tagTotal is None:
+            tagTotal = {"known": tagSummary["known"], "files": 0, "sections": 0, "repetitions": 0, "bytes": 0, "versions": {}}
+            totals[tag] = tagTotal
+        for version, versionSummary in tagSummary["versions"].items():
+            versionTotal = tagTotal["versions"].get(version)
+            if versionTotal is None:
+                versionTotal = {"known": versionSummary["known"], "files": 0, "sections": 0, "repetitions": 0, "bytes": 0}
+                tagTotal["versions"][version] = versionTotal
+            versionTotal["files"] += 1
+            for key in ("sections", "repetitions", "bytes"):
+                versionTotal[key] += versionSummary[key]
+        tagTotal["files"] += 1
+        for key in ("sections", "repetitions", "bytes"):
+            tagTotal[key] += tagSummary[key]
+
+def printTotals(totals, byVersion):
+    print("%-6s %-8s %-7s %8s %10s %12s %14s" % ("tag", "version", "known", "files", "sections", "repetitions", "bytes"))
+    for tag, tagTotal in sorted(totals.items(), key=lambda item: -item[1]["bytes"]):
+        if byVersion:
+            for version, versionTotal in sorted(tagTotal["versions"].items()):
+                print("%-6s %-8s %-7s %8d %10d %12d %14d" % (tag, version, versionTotal["known"], versionTotal["files"], versionTotal["sections"], versionTotal["repetitions"], versionTotal["bytes"]))
+        else:
+            versions = ",".join(str(version) for version in sorted(tagTotal["versions"]))
+            print("%-6s %-8s %-7s %8d %10d %12d %14d" % (tag, versions, tagTotal["known"], tagTotal["files"], tagTotal["sections"], tagTotal["repetitions"], tagTotal["bytes"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inventory m3 files by reading only their header and index table.')
+    parser.add_argument('path', nargs='+', help="Either a *.m3 file or a directory with *.m3 files")
+    parser.add_argument('-r', '--recurse', action='store_true', default=False, help='Scan also the subdirectories of directories')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes which scan files in parallel')
+    parser.add_argument('--by-version', action='store_true', default=False, help='Print a line per tag and version instead of per tag')
+    parser.add_argument('--json', help='Write the scan result of each file and the totals as JSON to this file, or to stdout with -')
+    args = parser.parse_args()
+
+    for path in args.path:
+        if not os.path.isdir(path) and not os.path.isfile(path):
+            sys.stderr.write("Path %s is not a valid directory or file\n" % path)
+            sys.exit(2)
+
+    startTime = time.time()
+    filePaths = []
+    for path in args.path:
+        filePaths.extend(batchTools.m3FilesIn(path, args.recurse))
+
+    if args.jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            scans = list(executor.map(scanFile, filePaths, chunksize=64))
+    else:
+        scans = [scanFile(filePath) for filePath in filePaths]
+
+    totals = {}
+    failed = 0
+    for scan in scans:
+        if "error" in scan:
+            failed += 1
+            sys.stderr.write("Error: %s\n" % scan["error"])
+        else:
+            addScanToTotals(scan, totals)
+    seconds = time.time() - startTime
+
+    if args.json is not None:
+        result = {"files": scans, "tags": totals, "failed": failed, "seconds": seconds}
+        if args.json == "-":
+            json.dump(result, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(args.json, "w") as jsonFile:
+                json.dump(result, jsonFile, indent=2)
+    if args.json != "-":
+        printTotals(totals, args.by_version)
+        print("%d files scanned, %d failed in %.2f s" % (len(scans), failed, seconds))
+    if failed > 0:
+        sys.exit(1)
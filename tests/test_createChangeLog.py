@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import copy
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3  # noqa: E402
+import generateModel  # noqa: E402
+import createChangeLog  # noqa: E402
+
+
+class BaselineChangeLog:
+    """ The comparison of fully loaded models which createChangeLog.py performed before it compared section hashes """
+
+    def __init__(self, previousModel, currentModel):
+        self.messages = []
+        self.changedAnimationIds = 0
+        self.compareM3Structures(previousModel, currentModel, "model")
+        if self.changedAnimationIds > 0:
+            self.messages.append("%d animation ids have changed!" % self.changedAnimationIds)
+
+    def compareM3Structures(self, previous, current, structurePath):
+        previousType = previous.structureDescription
+        currentType = current.structureDescription
+        if currentType.structureName != previousType.structureName:
+            self.messages.append("%s changed its structure type from %s to %s" % (structurePath, previousType.structureName, currentType.structureName))
+            return
+
+        if currentType.structureVersion != previousType.structureVersion:
+            self.messages.append("%s changed its structure version from %s to %s" % (structurePath, previousType.structureVersion, currentType.structureVersion))
+            return
+
+        for field in previousType.fields:
+            fieldPath = structurePath + "." + field.name
+            previousFieldContent = getattr(previous, field.name)
+            currentFieldContent = getattr(current, field.name)
+            if isinstance(field, m3.EmbeddedStructureField):
+                self.compareM3Structures(previousFieldContent, currentFieldContent, fieldPath)
+            elif isinstance(field, m3.StructureReferenceField):
+                if len(currentFieldContent) != len(previousFieldContent):
+                    self.messages.append("The length of %s changed from %d to %d" % (fieldPath, len(previousFieldContent), len(currentFieldContent)))
+                else:
+                    for elementIndex, (previousElement, currentElement) in enumerate(zip(previousFieldContent, currentFieldContent)):
+                        self.compareM3Structures(previousElement, currentElement, "%s[%d]" % (fieldPath, elementIndex))
+            elif currentFieldContent != previousFieldContent:
+                if field.name != "animId" and field.name != "uniqueUnknownNumber":
+                    if isinstance(field, m3.IntField):
+                        self.messages.append("%s changed from %s to %s" % (fieldPath, hex(previousFieldContent), hex(currentFieldContent)))
+                    else:
+                        self.messages.append("%s changed from %s to %s" % (fieldPath, previousFieldContent, currentFieldContent))
+                else:
+                    self.changedAnimationIds += 1
+
+
+class CollectingChangeLogCreator(createChangeLog.ChangeLogCreator):
+
+    def log(self, message):
+        self.messages.append(message)
+
+
+class ChangeLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.previousFilePath = os.path.join(self.directory.name, "previous.m3")
+        self.currentFilePath = os.path.join(self.directory.name, "current.m3")
+        model = generateModel.generateModel(vertexCount=20, boneCount=3, hierarchyDepth=2, sequenceCount=1, sequenceLengthInMS=100)
+        model.bones[2].location.initValue.y = float("nan")
+        m3.saveAndInvalidateModel(model, self.previousFilePath)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def changeLogOf(self, previousFilePath, currentFilePath):
+        creator = CollectingChangeLogCreator(currentFilePath, os.path.join(self.directory.name, "changelog.txt"))
+        creator.messages = []
+        creator.previousSnapshot = m3.HashedModel(previousFilePath)
+        creator.logChangesSincePreviousSnapshot()
+        return creator.messages
+
+    def baselineChangeLogOf(self, previousFilePath, currentFilePath):
+        return BaselineChangeLog(m3.loadModel(previousFilePath, checkExpectedValue=False), m3.loadModel(currentFilePath)).messages
+
+    def testSameLogAsBaseline(self):
+        model = m3.loadModel(self.previousFilePath)
+        model.bones[1].name = "Renamed"
+        model.bones[0].location.initValue.x = 0.5
+        model.bones[0].flags = 0
+        model.bones[1].rotation.header.animId = 123
+        model.vertices[5] ^= 0xff
+        model.divisions[0].faces[3] = 7
+        model.sequences.append(copy.copy(model.sequences[0]))
+        m3.saveAndInvalidateModel(model, self.currentFilePath)
+
+        messages = self.changeLogOf(self.previousFilePath, self.currentFilePath)
+        self.assertEqual(messages, self.baselineChangeLogOf(self.previousFilePath, self.currentFilePath))
+        self.assertIn("model.bones[1].name changed from Bone1 to Renamed", messages)
+        self.assertIn("model.bones[2].location.initValue.y changed from nan to nan", messages)
+        self.assertIn("The length of model.sequences changed from 1 to 2", messages)
+        self.assertIn("1 animation ids have changed!", messages)
+
+    def testUnchangedModelWithNaN(self):
+        messages = self.changeLogOf(self.previousFilePath, self.previousFilePath)
+        self.assertEqual(messages, self.baselineChangeLogOf(self.previousFilePath, self.previousFilePath))
+        self.assertEqual(messages, ["model.bones[2].location.initValue.y changed from nan to nan"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3  # noqa: E402
+import generateModel  # noqa: E402
+
+
+class ModelQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filePath = os.path.join(self.directory.name, "model.m3")
+        model = generateModel.generateModel(vertexCount=20, boneCount=3, hierarchyDepth=2, sequenceCount=1, sequenceLengthInMS=100)
+        m3.saveAndInvalidateModel(model, self.filePath)
+        self.boneNames = [bone.name for bone in m3.loadModel(self.filePath).bones]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testSeveralQueriesInARow(self):
+        modelQuery = m3.ModelQuery(self.filePath)
+        bones = modelQuery.query("model.bones")[0]
+        self.assertEqual([bone.name for bone in bones], self.boneNames)
+        self.assertEqual(modelQuery.query("model.bones[*].name"), self.boneNames)
+        firstBone = modelQuery.query("model.bones[0]")[0]
+        self.assertEqual(firstBone.name, self.boneNames[0])
+        self.assertEqual(modelQuery.query("model.bones[0].name"), self.boneNames[:1])
+        self.assertEqual(modelQuery.query("model.bones[0]")[0].name, self.boneNames[0])
+        self.assertEqual(modelQuery.query("BONE.name"), self.boneNames)
+        self.assertEqual(modelQuery.query("model")[0].bones[-1].name, self.boneNames[-1])
+        self.assertEqual(modelQuery.query("model.bones[-1].name"), self.boneNames[-1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
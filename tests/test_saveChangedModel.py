@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3  # noqa: E402
+import generateModel  # noqa: E402
+
+
+class SaveChangedModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.originalFilePath = os.path.join(self.directory.name, "original.m3")
+        self.changedFilePath = os.path.join(self.directory.name, "changed.m3")
+        model = generateModel.generateModel(vertexCount=20, boneCount=3, hierarchyDepth=2, sequenceCount=1, sequenceLengthInMS=100)
+        m3.saveAndInvalidateModel(model, self.originalFilePath)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def saveAndReload(self, model):
+        incremental = m3.saveChangedModel(model, self.changedFilePath)
+        return incremental, m3.loadModel(self.changedFilePath)
+
+    def testChangedValueGetsSavedIncrementally(self):
+        model = m3.loadModel(self.originalFilePath, trackChanges=True)
+        model.bones[1].flags = 0
+        incremental, reloadedModel = self.saveAndReload(model)
+        self.assertTrue(incremental)
+        self.assertEqual(reloadedModel.bones[1].flags, 0)
+
+    def testEmptiedReference(self):
+        for emptyName in ("", None):
+            model = m3.loadModel(self.originalFilePath, trackChanges=True)
+            otherBoneName = model.bones[2].name
+            model.bones[1].name = emptyName
+            incremental, reloadedModel = self.saveAndReload(model)
+            self.assertFalse(incremental)
+            self.assertFalse(reloadedModel.bones[1].name)
+            self.assertEqual(reloadedModel.bones[2].name, otherBoneName)
+
+    def testReferenceToAnotherSection(self):
+        model = m3.loadModel(self.originalFilePath, trackChanges=True)
+        otherBoneName = model.bones[2].name
+        model.bones[1].name = model.bones[2].name
+        incremental, reloadedModel = self.saveAndReload(model)
+        self.assertFalse(incremental)
+        self.assertEqual(reloadedModel.bones[1].name, otherBoneName)
+        self.assertEqual(reloadedModel.bones[2].name, otherBoneName)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3  # noqa: E402
+
+
+class SchemaTest(unittest.TestCase):
+
+    def testVerifySchema(self):
+        # Checks the sizes of all versions of all structures, which loadModel only does for the versions it uses:
+        m3.verifySchema()
+        for structureHistory in m3.structures.values():
+            for version, size in structureHistory.versionToSizeMap.items():
+                self.assertEqual(structureHistory.getVersion(version).size, size)
+
+    def testSizeMismatchGetsDetected(self):
+        structureHistory = m3.structures["VEC3"]
+        fields = structureHistory.getVersion(0).fields
+        with self.assertRaises(Exception):
+            m3.M3StructureDescription("VEC3", 0, fields[:-1], 12, structureHistory)
+
+
+if __name__ == "__main__":
+    unittest.main()
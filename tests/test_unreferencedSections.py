@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import io
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3  # noqa: E402
+import generateModel  # noqa: E402
+
+
+class UnreferencedSectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filePath = os.path.join(self.directory.name, "model.m3")
+        model = generateModel.generateModel(vertexCount=20, boneCount=3, hierarchyDepth=2, sequenceCount=1, sequenceLengthInMS=100)
+        m3.saveAndInvalidateModel(model, self.filePath)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testReferencesGetIndexed(self):
+        sections = m3.loadSections(self.filePath)
+        m3.resolveReferencesOfSections(sections)
+        for section in sections:
+            for index, entries, flags, offset, fieldPath in section.determineReferences():
+                if entries > 0:
+                    self.assertLessEqual(entries, sections[index].indexEntry.repetitions)
+                if section.indexEntry.tag == "BONE" and fieldPath == "name":
+                    self.assertEqual(offset % section.structureDescription.size, 4)
+
+    def testUnreferencedSectionGetsReported(self):
+        sections = m3.loadSections(self.filePath)
+        boneSection = next(section for section in sections if section.indexEntry.tag == "BONE")
+        nameReferences = [reference for reference in boneSection.determineReferences() if reference[4] == "name"]
+        index, entries, flags, offset, fieldPath = nameReferences[1]
+        with open(self.filePath, "rb") as f:
+            buffer = bytearray(f.read())
+        struct.pack_into("<I", buffer, boneSection.indexEntry.offset + offset, 0)
+        with open(self.filePath, "wb") as f:
+            f.write(buffer)
+
+        log = io.StringIO()
+        with mock.patch.object(m3, "stderr", log):
+            with self.assertRaisesRegex(Exception, "There were 1 unreferenced sections"):
+                m3.loadModel(self.filePath)
+        expectedLine = "  -> Field name of record 1 in a section of type BONEV1 (offset %d) references it with 0 entries and flags 0x%08x\n" % (offset, flags)
+        self.assertIn(expectedLine, log.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
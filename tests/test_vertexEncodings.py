@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+import os
+import sys
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3  # noqa: E402
+import generateModel  # noqa: E402
+import m3ToXml  # noqa: E402
+import xmlToM3  # noqa: E402
+
+
+class VertexEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.m3FilePath = os.path.join(self.directory.name, "model.m3")
+        self.xmlFilePath = os.path.join(self.directory.name, "model.m3.xml")
+        self.convertedFilePath = os.path.join(self.directory.name, "converted.m3")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def saveModel(self, model):
+        m3.saveAndInvalidateModel(model, self.m3FilePath)
+        with open(self.m3FilePath, "rb") as m3File:
+            return m3File.read()
+
+    def convertToXmlAndBack(self, vertexEncoding):
+        m3ToXml.convertModel(self.m3FilePath, self.xmlFilePath, vertexEncoding=vertexEncoding)
+        xmlToM3.convertXmlFile(self.xmlFilePath, self.convertedFilePath)
+        with open(self.xmlFilePath) as xmlFile:
+            xmlText = xmlFile.read()
+        with open(self.convertedFilePath, "rb") as m3File:
+            return xmlText, m3File.read()
+
+    def testRoundTrip(self):
+        originalBytes = self.saveModel(generateModel.generateModel(vertexCount=100))
+        for vertexEncoding in m3ToXml.vertexEncodings:
+            xmlText, convertedBytes = self.convertToXmlAndBack(vertexEncoding)
+            self.assertIn('<vertices', xmlText)
+            self.assertEqual(convertedBytes, originalBytes, vertexEncoding)
+
+    def testNanWithPayloadFallsBackToBase64(self):
+        model = generateModel.generateModel(vertexCount=100)
+        vertexDescription = m3.structures["VertexFormat" + hex(model.vFlags)].getVersion(0)
+        offset = 0
+        for columnName, formatChar in vertexDescription.rawColumnFormats():
+            if columnName == "position.x":
+                break
+            offset += struct.calcsize("<" + formatChar)
+        # A quiet NaN with payload, which is not the one that float("nan") returns:
+        model.vertices[offset:offset + 4] = struct.pack("<I", 0x7fc00001)
+        originalBytes = self.saveModel(model)
+        xmlText, convertedBytes = self.convertToXmlAndBack("columns")
+        self.assertIn('encoding="base64"', xmlText)
+        self.assertEqual(convertedBytes, originalBytes)
+
+
+if __name__ == "__main__":
+    unittest.main()
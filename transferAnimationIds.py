@@ -31,8 +31,10 @@ if __name__ == "__main__":
     parser.add_argument('outputFile', help="name of the new m3 file to create")
     args = parser.parse_args()
 
-    animIdModel = m3.loadModel(args.animIdFile)
-    modelToFix = m3.loadModel(args.modelToFix)
+    # Only the bones and the divisions of this model get read:
+    animIdModel = m3.loadModel(args.animIdFile, lazy=True)
+    # Only animation ids get changed, so only the modified sections need to be encoded again:
+    modelToFix = m3.loadModel(args.modelToFix, trackChanges=True)
     outputFile = args.outputFile
 
     boneNameToAnimIdBoneMap = {}
@@ -84,5 +86,5 @@ if __name__ == "__main__":
             if newAnimId is not None:
                 animIds[i] = newAnimId
 
-    m3.saveAndInvalidateModel(modelToFix, outputFile)
+    m3.saveChangedModel(modelToFix, outputFile)
 
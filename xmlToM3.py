@@ -21,154 +21,303 @@
 
 import sys
 import m3
-import xml.dom.minidom
-from xml.dom.minidom import Node
+import batchTools
+import xml.sax
+import xml.sax.handler
 import argparse
 import os
 import time
+import base64
 
-def forElementsIn(xmlNode):
-    for child in xmlNode.childNodes:
-        if type(child) == xml.dom.minidom.Text:
-            if not child.wholeText.isspace():
-                raise Exception("Unexpected content \"%s\" within element %s" % (child.wholeText, xmlNode.nodeName))
-        else:
-            yield child
-
-def createSingleStructureElement(xmlNode, structureDescription):
-    createdObject = structureDescription.createInstance()
-    fieldIndex = 0
-    for child in forElementsIn(xmlNode):
-        fieldName = child.nodeName
-        if fieldIndex >= len(structureDescription.fields):
+primitiveListStructureNames = set(["CHAR", "I32_", "I16_", "I8__", "U32_", "U16_", "U8__", "REAL", "FLAG"])
+intListStructureNames = set(["I32_", "I16_", "I8__", "U32_", "U16_", "U8__", "FLAG"])
+intTypeStrings = set(["int32", "int16", "int8", "uint32", "uint16", "uint8"])
+
+def removeWhitespace(s):
+    return s.translate({ord(" "): None, ord("\t"): None, ord("\r"): None, ord("\n"): None})
+
+def hexToBytes(hexString, elementName):
+    hexString = removeWhitespace(hexString)
+    if hexString == "":
+        return bytearray(0)
+    if not hexString.startswith("0x"):
+        raise Exception('hex string "%s" of node %s does not start with 0x' % (hexString, elementName))
+    return bytes.fromhex(hexString[2:])
+
+
+class StructureElementBuilder:
+    """ Creates a structure from the elements of its fields """
+    def __init__(self, name, structureDescription):
+        self.name = name
+        self.structureDescription = structureDescription
+        self.createdObject = structureDescription.createInstance()
+        self.fieldIndex = 0
+
+    def createChildBuilder(self, childName, attributes):
+        structureDescription = self.structureDescription
+        if self.fieldIndex >= len(structureDescription.fields):
             raise Exception("XML file is incompatible: too many fields")
-        field = structureDescription.fields[fieldIndex]
-        if field.name != fieldName:
-            raise Exception("XML file is incompatible: Expected field %s but found field %s" % (field.name, fieldName))
+        field = structureDescription.fields[self.fieldIndex]
+        if field.name != childName:
+            raise Exception("XML file is incompatible: Expected field %s but found field %s" % (field.name, childName))
+        return createFieldContentBuilder(childName, attributes, field)
 
-        fieldContent = createFieldContent(child, field)
-        setattr(createdObject, field.name, fieldContent)
-        fieldIndex += 1
+    def addChildContent(self, childContent):
+        field = self.structureDescription.fields[self.fieldIndex]
+        setattr(self.createdObject, field.name, childContent)
+        self.fieldIndex += 1
 
-    missingFields = len(structureDescription.fields) - fieldIndex
-    if missingFields > 0:
-        raise Exception("XML file is incompatible: %d fields are missing in %s" % (missingFields, structureDescription.structureName))
+    def addText(self, text):
+        if not text.isspace():
+            raise Exception("Unexpected content \"%s\" within element %s" % (text, self.name))
 
-    return createdObject
+    def createContent(self):
+        missingFields = len(self.structureDescription.fields) - self.fieldIndex
+        if missingFields > 0:
+            raise Exception("XML file is incompatible: %d fields are missing in %s" % (missingFields, self.structureDescription.structureName))
+        return self.createdObject
 
 
-intTypeStrings = set(["int32", "int16", "int8", "uint32", "uint16", "uint8"])
-def createFieldContent(xmlNode, field):
+class ElementListBuilder:
+    """ Creates the list of a reference field from its -element child elements """
+    def __init__(self, name, attributes, historyOfReferencedStructure):
+        self.name = name
+        self.expectedChildName = name + "-element"
+        self.attributes = attributes
+        self.historyOfReferencedStructure = historyOfReferencedStructure
+        self.structureDescription = None
+        self.createdList = []
+
+    def determineStructureDescription(self):
+        historyOfReferencedStructure = self.historyOfReferencedStructure
+        if historyOfReferencedStructure.name in primitiveListStructureNames:
+            structVersion = 0
+        else:
+            structVersion = self.attributes.get("structureVersion", "")
+            structName = self.attributes.get("structureName", "")
+            if structName == "" or structVersion == "":
+                raise Exception("Incompatible format: Require now a strutureName and structureVerson attribute for the list %s" % self.name)
+            if structName != historyOfReferencedStructure.name:
+                raise Exception("Expected a %s to have the structure name %s instead of %s" % (self.name, historyOfReferencedStructure.name, structName))
+            structVersion = int(structVersion)
+        return historyOfReferencedStructure.getVersion(structVersion)
+
+    def createChildBuilder(self, childName, attributes):
+        if childName != self.expectedChildName:
+            raise Exception("Unexpected child \"%s\" within element %s" % (childName, self.name))
+        if self.structureDescription is None:
+            self.structureDescription = self.determineStructureDescription()
+        structureName = self.structureDescription.structureName
+        if structureName in intListStructureNames:
+            return TextElementBuilder(childName, parseInt)
+        elif structureName == "REAL":
+            return TextElementBuilder(childName, parseFloat)
+        else:
+            return StructureElementBuilder(childName, self.structureDescription)
+
+    def addChildContent(self, childContent):
+        self.createdList.append(childContent)
+
+    def addText(self, text):
+        if not text.isspace():
+            raise Exception("Unexpected content \"%s\" within element %s" % (text, self.name))
+
+    def createContent(self):
+        return self.createdList
+
+
+class TextElementBuilder:
+    """ Converts the text content of an element with the function createContentFromText(text, elementName) """
+    def __init__(self, name, createContentFromText):
+        self.name = name
+        self.createContentFromText = createContentFromText
+        self.textParts = []
+
+    def createChildBuilder(self, childName, attributes):
+        raise Exception("Element %s contained the child element %s." % (self.name, childName))
+
+    def addText(self, text):
+        self.textParts.append(text)
+
+    def createContent(self):
+        return self.createContentFromText("".join(self.textParts), self.name)
+
+
+class VertexColumnsBuilder:
+    """ Creates the vertex bytes from column elements written by m3ToXml.py with --vertex-encoding columns """
+    def __init__(self, name, attributes):
+        self.name = name
+        structName = attributes.get("structureName", "")
+        structVersion = attributes.get("structureVersion", "")
+        if structName == "" or structVersion == "":
+            raise Exception("The element %s with encoding columns requires a structureName and structureVersion attribute" % name)
+        self.structureDescription = m3.structures[structName].getVersion(int(structVersion))
+        self.columnFormats = self.structureDescription.rawColumnFormats()
+        self.columnNameToValuesMap = {}
+
+    def createChildBuilder(self, childName, attributes):
+        if childName != "column":
+            raise Exception("Unexpected child \"%s\" within element %s" % (childName, self.name))
+        columnName = attributes.get("name")
+        return TextElementBuilder(columnName, parseFloatColumn if attributes.get("format") in ("f", "d") else parseIntColumn)
+
+    def addChildContent(self, childContent):
+        columnName, values = childContent
+        self.columnNameToValuesMap[columnName] = values
+
+    def addText(self, text):
+        if not text.isspace():
+            raise Exception("Unexpected content \"%s\" within element %s" % (text, self.name))
+
+    def createContent(self):
+        columns = []
+        for columnName, formatChar in self.columnFormats:
+            if columnName not in self.columnNameToValuesMap:
+                raise Exception("The column %s is missing in element %s" % (columnName, self.name))
+            columns.append(self.columnNameToValuesMap[columnName])
+        return self.structureDescription.rawColumnsToBytes(columns)
+
+
+class IgnoredElementBuilder:
+    """ Used for references to sections of unknown structure which are always empty """
+    def __init__(self, content):
+        self.content = content
+
+    def createChildBuilder(self, childName, attributes):
+        return IgnoredElementBuilder(None)
+
+    def addChildContent(self, childContent):
+        pass
+
+    def addText(self, text):
+        pass
+
+    def createContent(self):
+        return self.content
+
+
+def parseInt(text, elementName):
+    return int(text, 0)
+
+def parseFloat(text, elementName):
+    return float(text)
+
+def parseString(text, elementName):
+    if text == "":
+        return None
+    return text
+
+def parseByteArray(text, elementName):
+    return bytearray(hexToBytes(text, elementName))
+
+def parseBase64ByteArray(text, elementName):
+    return bytearray(base64.b64decode(removeWhitespace(text), validate=True))
+
+def parseFloatColumn(text, columnName):
+    return columnName, list(map(float, text.split()))
+
+def parseIntColumn(text, columnName):
+    return columnName, list(map(int, text.split()))
+
+def createByteArrayBuilder(name, attributes):
+    encoding = attributes.get("encoding", "hex")
+    if encoding == "hex":
+        return TextElementBuilder(name, parseByteArray)
+    elif encoding == "base64":
+        return TextElementBuilder(name, parseBase64ByteArray)
+    elif encoding == "columns":
+        return VertexColumnsBuilder(name, attributes)
+    else:
+        raise Exception("Unknown encoding %s of element %s" % (encoding, name))
+
+def createFieldContentBuilder(name, attributes, field):
     if isinstance(field, m3.ReferenceField):
         if field.historyOfReferencedStructures is None:
-            return [] # TODO check if that's correct
+            return IgnoredElementBuilder([]) # TODO check if that's correct
         else:
             referencedStructureName = field.historyOfReferencedStructures.name
             if referencedStructureName == "CHAR":
-                if len(xmlNode.childNodes) == 0:
-                    return None
-                return stringContentOf(xmlNode)
+                return TextElementBuilder(name, parseString)
             elif referencedStructureName == "U8__":
-                return bytearray(hexToBytes(stringContentOf(xmlNode), xmlNode))
+                return createByteArrayBuilder(name, attributes)
             else:
-                if field.historyOfReferencedStructures is not None:
-                    return createElementList(xmlNode, field.name, field.historyOfReferencedStructures)
-                else:
-                    return createElementList(xmlNode, field.name, None)
+                return ElementListBuilder(name, attributes, field.historyOfReferencedStructures)
 
     elif isinstance(field, m3.UnknownBytesField):
-        return hexToBytes(stringContentOf(xmlNode), xmlNode)
+        return TextElementBuilder(name, hexToBytes)
     elif isinstance(field, m3.PrimitiveField):
         if field.typeString == "float":
-            return float(stringContentOf(xmlNode))
+            return TextElementBuilder(name, parseFloat)
         elif field.typeString in intTypeStrings:
-            return int(stringContentOf(xmlNode), 0)
+            return TextElementBuilder(name, parseInt)
         else:
             raise Exception("Unsupported primtive: %s" % field.typeString)
     elif isinstance(field, m3.EmbeddedStructureField):
-        return createSingleStructureElement(xmlNode, field.structureDescription)
+        return StructureElementBuilder(name, field.structureDescription)
     else: # TagField
         raise Exception("Unsupported field type %s" % type(field))
 
-def removeWhitespace(s):
-    return s.translate({ord(" "): None, ord("\t"): None, ord("\r"): None, ord("\n"): None})
 
-def hexToBytes(hexString, xmlNode):
-    hexString = removeWhitespace(hexString)
-    if hexString == "":
-        return bytearray(0)
-    if not hexString.startswith("0x"):
-        raise Exception('hex string "%s" of node %s does not start with 0x' % (hexString, xmlNode.nodeName))
-    hexString = hexString[2:]
-    return bytes([int(hexString[x: x + 2], 16) for x in range(0, len(hexString), 2)])
-
-def stringContentOf(xmlNode):
-    content = ""
-    for child in xmlNode.childNodes:
-        if child.nodeType == Node.TEXT_NODE:
-            content += child.data
-        else:
-            raise Exception("Element %s contained childs of xml node type %s." % (xmlNode.nodeName, type(xmlNode)))
-    return content
-
-def createListElement(xmlNode, structureDescription):
-    if structureDescription.structureName in ["I32_", "I16_", "I8__", "U32_", "U16_", "U8__", "FLAG"]:
-        return int(stringContentOf(xmlNode), 0)
-    elif structureDescription.structureName in ["REAL"]:
-        return float(stringContentOf(xmlNode))
-    else:
-        return createSingleStructureElement(xmlNode, structureDescription)
+class ModelContentHandler(xml.sax.handler.ContentHandler):
+    """ Creates the model while parsing. Only the builders of the currently open elements are kept in memory """
+    def __init__(self):
+        super().__init__()
+        self.builderStack = []
+        self.model = None
 
+    def startElement(self, name, attributes):
+        if len(self.builderStack) == 0:
+            structVersion = int(attributes.get("structureVersion"))
+            structName = attributes.get("structureName")
+            modelDescription = m3.structures[structName].getVersion(structVersion)
+            self.builderStack.append(StructureElementBuilder(name, modelDescription))
+        else:
+            self.builderStack.append(self.builderStack[-1].createChildBuilder(name, attributes))
 
-def childElementsOf(parentName, xmlNode):
-    expectedChildNames = parentName + "-element"
-    for child in xmlNode.childNodes:
-        if type(child) == xml.dom.minidom.Text:
-            if not child.data.isspace():
-                raise Exception("Unexpected content \"%s\" within element %s" % (child.wholeText, xmlNode.nodeName))
+    def endElement(self, name):
+        content = self.builderStack.pop().createContent()
+        if len(self.builderStack) == 0:
+            self.model = content
         else:
-            if (child.nodeName != expectedChildNames):
-                raise Exception("Unexpected child \"%s\" within element %s", (child.nodeName, xmlNode.nodeName))
-            yield child
-
-def createElementList(xmlNode, parentName, historyOfReferencedStructure):
-    xmlElements = list(childElementsOf(parentName, xmlNode))
-    if historyOfReferencedStructure.name in ["CHAR", "I32_", "I16_", "I8__", "U32_", "U16_", "U8__", "REAL", "FLAG"]:
-        structVersion = 0
-    else:
-        if len(xmlElements) == 0:
-            return []
+            self.builderStack[-1].addChildContent(content)
+
+    def characters(self, content):
+        if len(self.builderStack) > 0:
+            self.builderStack[-1].addText(content)
 
-        child = xmlNode.firstChild
-        structVersion = int(xmlNode.getAttribute("structureVersion"))
-        structName = xmlNode.getAttribute("structureName")
-        if structName == "" or structVersion == "":
-            raise Exception("Incompatible format: Require now a strutureName and structureVerson attribute for the list %s" % parentName)
-        if structName != historyOfReferencedStructure.name:
-            raise Exception("Expected a %s to have the structure name %s instead of %s" % (parentName, historyOfReferencedStructure.name, structName))
-    structureDescription = historyOfReferencedStructure.getVersion(structVersion)
-    createdList = []
-    for child in xmlElements:
-        o = createListElement(child, structureDescription)
-        createdList.append(o)
 
-    return createdList
+def loadXmlModel(inputFilePath):
+    contentHandler = ModelContentHandler()
+    xml.sax.parse(inputFilePath, contentHandler)
+    return contentHandler.model
 
 
-def convertFile(inputFilePath, outputDirectory):
+def outputFilePathFor(inputFilePath, outputDirectory):
     if outputDirectory is not None:
         fileName = os.path.basename(inputFilePath)
-        outputFilePath = os.path.join(outputDirectory, fileName[:-4])
+        return os.path.join(outputDirectory, fileName[:-4])
     else:
-        outputFilePath = inputFilePath[:-4]
+        return inputFilePath[:-4]
+
+def convertFile(inputFilePath, outputDirectory, validation="full", deduplicate=False):
+    outputFilePath = outputFilePathFor(inputFilePath, outputDirectory)
     print("Converting %s -> %s" % (inputFilePath, outputFilePath))
-    doc = xml.dom.minidom.parse(inputFilePath)
-    modelElement = doc.firstChild
-    structVersion = int(modelElement.getAttribute("structureVersion"))
-    structName = modelElement.getAttribute("structureName")
-    modelDescription = m3.structures[structName].getVersion(structVersion)
-    model = createSingleStructureElement(modelElement, modelDescription)
-    m3.saveAndInvalidateModel(model, outputFilePath)
+    details = convertXmlFile(inputFilePath, outputFilePath, validation, deduplicate)
+    if details is not None:
+        print(deduplicationMessage(outputFilePath, details))
+
+def convertXmlFile(inputFilePath, outputFilePath, validation="full", deduplicate=False):
+    """ Returns the saved bytes per tag if deduplicate is True """
+    model = loadXmlModel(inputFilePath)
+    savedBytesPerTag = m3.saveAndInvalidateModel(model, outputFilePath, validation, deduplicate=deduplicate)
+    if deduplicate:
+        return {"savedBytesPerTag": savedBytesPerTag}
+    return None
+
+def deduplicationMessage(outputFilePath, details):
+    savedBytesPerTag = details["savedBytesPerTag"]
+    savedBytesText = ", ".join("%s: %d" % (tag, savedBytes) for tag, savedBytes in sorted(savedBytesPerTag.items()))
+    return "%s: Deduplication saved %d bytes (%s)" % (outputFilePath, sum(savedBytesPerTag.values()), savedBytesText)
 
 
 if __name__ == "__main__":
@@ -176,6 +325,11 @@ if __name__ == "__main__":
     parser.add_argument('path', nargs='+', help="Either a *.m3.xml file or a directory with *.m3.xml files generated with m3ToXml.py")
     parser.add_argument('--output-directory', '-o', help='Directory in which m3 files will be placed')
     parser.add_argument('--watch', action='store_const', const=True, default=False)
+    parser.add_argument('--validation', choices=m3.validationLevels, default="full", help='How thoroughly the model gets validated before saving it')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes which convert files in parallel')
+    parser.add_argument('--continue-at-errors', '-c', action='store_true', default=False, help='Continue if there are errors in the files')
+    parser.add_argument('--deduplicate', action='store_true', default=False, help='Store sections with identical content like strings or key frames only once')
+    parser.add_argument('--summary', help='Write the conversion time and result of each file as JSON to this file, or to stdout with -')
     args = parser.parse_args()
     outputDirectory = args.output_directory
     if outputDirectory is not None and not os.path.isdir(outputDirectory):
@@ -192,29 +346,35 @@ if __name__ == "__main__":
             sys.exit(2)
 
         previousModelModiticationTime = os.path.getmtime(filePath)
-        convertFile(filePath, outputDirectory)
+        convertFile(filePath, outputDirectory, args.validation, args.deduplicate)
         print("Converted %s to an m3 file. Will convert it again if it changes" % filePath)
         while True:
             currentModelModificationTime = os.path.getmtime(filePath)
             if currentModelModificationTime > previousModelModiticationTime:
                 print("File modified at %s, converting again" % time.ctime(currentModelModificationTime))
-                convertFile(filePath, outputDirectory)
+                convertFile(filePath, outputDirectory, args.validation, args.deduplicate)
                 print("converted file")
                 previousModelModiticationTime = currentModelModificationTime
             time.sleep(0.1)
     else:
-        counter = 0
+        startTime = time.time()
+        filePathPairs = []
         for filePath in args.path:
-            if os.path.isdir(filePath):
-                for fileName in os.listdir(filePath):
-                    inputFilePath = os.path.join(filePath, fileName)
-                    if fileName.endswith(".m3.xml"):
-                        convertFile(inputFilePath, outputDirectory)
-                        counter += 1
-            else:
-                convertFile(filePath, outputDirectory)
-                counter += 1
+            for inputFilePath in batchTools.m3FilesIn(filePath, recurse=False, extension=".m3.xml"):
+                filePathPairs.append((inputFilePath, outputFilePathFor(inputFilePath, outputDirectory)))
+        # Keep stdout free for the JSON summary if it gets written there
+        progressFile = sys.stderr if args.summary == "-" else sys.stdout
+        results = batchTools.runFileConversions(convertXmlFile, filePathPairs, args.jobs, args.continue_at_errors, (args.validation, args.deduplicate), progressFile)
+        if args.deduplicate:
+            for result in results:
+                if result["success"]:
+                    progressFile.write(deduplicationMessage(result["output"], result) + "\n")
+        if args.summary is not None:
+            batchTools.writeConversionSummary(results, args.summary, time.time() - startTime)
+        counter = sum(1 for result in results if result["success"])
         if counter == 1:
-            print("Converted %d file from .m3.xml to .m3" % counter)
+            progressFile.write("Converted %d file from .m3.xml to .m3\n" % counter)
         else:
-            print("Converted %d files from .m3.xml to .m3" % counter)
+            progressFile.write("Converted %d files from .m3.xml to .m3\n" % counter)
+        if counter != len(filePathPairs):
+            sys.exit(1)